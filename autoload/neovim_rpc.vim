@@ -23,22 +23,40 @@ func! neovim_rpc#serveraddr()
         throw '[vim-hug-neovim-rpc] requires `:set encoding=utf-8`'
     endif
 
-    try
-        call s:py('import pynvim')
-    catch
-        try
-            call s:py('import neovim')
-        catch
-            call neovim_rpc#_error("failed executing: " .
-                        \ g:neovim_rpc#py . " import [pynvim|neovim]")
-            call neovim_rpc#_error(v:exception)
-            throw '[vim-hug-neovim-rpc] requires one of `:' . g:neovim_rpc#py .
-                        \ ' import [pynvim|neovim]` command to work'
-        endtry
-    endtry
+    let l:begin = reltime()
+    let l:start = l:begin
+
+    " only check for existence, importing pynvim is expensive and the server
+    " doesn't need it
+    if !s:has_module('pynvim') && !s:has_module('neovim')
+        call neovim_rpc#_error("failed executing: " .
+                    \ g:neovim_rpc#py . " import [pynvim|neovim]")
+        throw '[vim-hug-neovim-rpc] requires one of `:' . g:neovim_rpc#py .
+                    \ ' import [pynvim|neovim]` command to work'
+    endif
+    let l:start = s:profile('check_pynvim', l:start)
 
     call s:py('import neovim_rpc_server')
+    let l:start = s:profile('import_server', l:start)
+
     let l:servers = s:pyeval('neovim_rpc_server.start()')
+    let l:start = s:profile('start', l:start)
+
+    " drop the cached buffer and window handles, detach unloaded buffers
+    call s:py('import neovim_rpc_protocol')
+    augroup neovim_rpc_handles
+        autocmd!
+        autocmd BufWipeout * execute g:neovim_rpc#py
+                    \ 'neovim_rpc_protocol.handles.forget_buffer(' .
+                    \ expand('<abuf>') . ')'
+        autocmd BufUnload * execute g:neovim_rpc#py
+                    \ 'neovim_rpc_server.buf_unloaded(' . expand('<abuf>') . ')'
+        if exists('##WinClosed')
+            autocmd WinClosed * execute g:neovim_rpc#py
+                        \ 'neovim_rpc_protocol.handles.forget_window(' .
+                        \ expand('<amatch>') . ')'
+        endif
+    augroup END
 
     let g:_neovim_rpc_nvim_server     = l:servers[0]
     let g:_neovim_rpc_vim_server = l:servers[1]
@@ -47,16 +65,91 @@ func! neovim_rpc#serveraddr()
 
     " identify myself
     call ch_sendexpr(g:_neovim_rpc_main_channel,'neovim_rpc_setup')
+    let l:start = s:profile('ch_open', l:start)
+    call s:profile('total', l:begin)
 
     return g:_neovim_rpc_nvim_server
 endfunc
 
+" options of neovim_rpc_server.prepare()
+func! neovim_rpc#_server_options()
+    return {
+                \ 'read_size': get(g:, 'neovim_rpc_read_size', 64 * 1024),
+                \ 'server_mode': get(g:, 'neovim_rpc_server_mode', 'thread'),
+                \ 'channel_max_messages':
+                \     get(g:, 'neovim_rpc_channel_max_messages', 10000),
+                \ 'channel_max_bytes':
+                \     get(g:, 'neovim_rpc_channel_max_bytes', 256 * 1024 * 1024),
+                \ 'full_api_info': get(g:, 'neovim_rpc_full_api_info', 0),
+                \ 'tempname': tempname(),
+                \ }
+endfunc
+
+" called at VimEnter when g:neovim_rpc_warmup is set, prepares the servers on
+" a background thread and opens the vim channel from a timer afterwards
+func! neovim_rpc#_warmup()
+    if exists('g:_neovim_rpc_nvim_server') || &encoding !=? "utf-8"
+        return
+    endif
+    call s:py('import neovim_rpc_warmup, vim')
+    call s:py('neovim_rpc_warmup.start(vim.eval("neovim_rpc#_server_options()"))')
+    call timer_start(10, function('s:warmup_poll'), {'repeat': -1})
+endfunc
+
+func! s:warmup_poll(timer)
+    if !exists('g:_neovim_rpc_nvim_server') &&
+                \ !s:pyeval('neovim_rpc_warmup.done()')
+        return
+    endif
+    call timer_stop(a:timer)
+    try
+        " returns right away if it has been called in the meantime
+        call neovim_rpc#serveraddr()
+    catch
+        call neovim_rpc#_error(v:exception)
+    endtry
+endfunc
+
+func! s:has_module(name)
+    call s:py('import sys')
+    if s:pyeval('sys.version_info[0]') == 2
+        try
+            call s:py('import imp; imp.find_module("' . a:name . '")')
+            return 1
+        catch
+            return 0
+        endtry
+    endif
+    call s:py('import importlib.util')
+    return s:pyeval('importlib.util.find_spec("' . a:name . '") is not None')
+endfunc
+
+let s:startup_profile = {}
+
+func! s:profile(phase, start)
+    let s:startup_profile[a:phase] = reltimefloat(reltime(a:start)) * 1000
+    return reltime()
+endfunc
+
+" milliseconds spent in each phase of the first neovim_rpc#serveraddr() call,
+" start_* phases are parts of start
+func! neovim_rpc#startup_profile()
+    let l:profile = copy(s:startup_profile)
+    if has_key(l:profile, 'start')
+        call extend(l:profile, s:pyeval('neovim_rpc_server.startup_profile()'))
+    endif
+    return l:profile
+endfunc
+
 " elegant python function call wrapper
 func! neovim_rpc#pyxcall(func,...)
     call s:py('import vim, json')
     let g:neovim_rpc#_tmp_args = copy(a:000)
     let l:ret = s:pyeval(a:func . '(*vim.vars["neovim_rpc#_tmp_args"])')
-    unlet g:neovim_rpc#_tmp_args
+    " the arguments are read before the call, a nested pyxcall, e.g. from a
+    " function called by a client while rpcrequest waits, may have removed
+    " the variable already
+    unlet! g:neovim_rpc#_tmp_args
     return l:ret
 endfunc
 
@@ -108,6 +201,24 @@ endfunc
 
 let s:rspid = 1
 func! neovim_rpc#rpcrequest(channel, event, ...)
+    if get(g:, 'neovim_rpc_direct_request', 1)
+        " send the request and wait for the response inside python
+        let [err, result] = neovim_rpc#pyxcall('neovim_rpc_server.rpcrequest',
+                    \ a:channel, a:event, a:000)
+    else
+        let [err, result] = s:rpcrequest_by_channel(a:channel, a:event, a:000)
+    endif
+    if !empty(err)
+        if type(err) == type('')
+            throw err
+        endif
+        throw err[1]
+    endif
+    return result
+endfunc
+
+" fallback for vim builds where blocking inside python is unsafe
+func! s:rpcrequest_by_channel(channel, event, args)
     let s:rspid = s:rspid + 1
 
     " a unique key for storing response
@@ -115,20 +226,50 @@ func! neovim_rpc#rpcrequest(channel, event, ...)
 
     " neovim's rpcrequest doesn't have timeout
     let opt = {'timeout': 24 * 60 * 60 * 1000}
-    let args = ['rpcrequest', a:channel, a:event, a:000, rspid]
+    let args = ['rpcrequest', a:channel, a:event, a:args, rspid]
     call ch_evalexpr(g:_neovim_rpc_main_channel, args, opt)
 
-    let expr = 'neovim_rpc_server.responses.pop("' . rspid . '")'
+    let expr = 'neovim_rpc_server.pop_response("' . rspid . '")'
 
     call s:py('import neovim_rpc_server, json')
-    let [err, result] = s:pyeval(expr)
-    if err
-        if type(err) == type('')
-            throw err
-        endif
-        throw err[1]
+    return s:pyeval(expr)
+endfunc
+
+" The callback is called as callback(err, result) on the main thread once the
+" client responds. Returns an id of the request. Any number of requests may
+" be outstanding on the same channel.
+let s:async_cbid = 0
+let s:async_callbacks = {}
+func! neovim_rpc#rpcrequest_async(channel, event, args, callback)
+    let s:async_cbid = s:async_cbid + 1
+    let cbid = s:async_cbid
+    let s:async_callbacks[cbid] = a:callback
+    let ok = neovim_rpc#pyxcall('neovim_rpc_server.rpcrequest_async',
+                \ a:channel, a:event, a:args, cbid)
+    if !ok
+        unlet s:async_callbacks[cbid]
+        throw '[vim-hug-neovim-rpc] rpcrequest_async failed on channel ' .
+                    \ a:channel
     endif
-    return result
+    return cbid
+endfunc
+
+func! neovim_rpc#_on_async_response(cbid, err, result)
+    let l:Callback = remove(s:async_callbacks, a:cbid)
+    call call(l:Callback, [a:err, a:result])
+endfunc
+
+" listener_add() callback of the buffers attached with nvim_buf_attach, it
+" may be invoked in the middle of a pyxcall, which must keep its arguments
+func! neovim_rpc#_on_buf_lines(bufnr, start, end, added, changes)
+    execute g:neovim_rpc#py 'import vim; neovim_rpc_server.buf_lines_changed('
+                \ . a:bufnr . ', vim.bindeval("a:changes"))'
+endfunc
+
+" counters for tuning the server, see neovim_rpc_server._stats
+func! neovim_rpc#stats()
+    call s:py('import neovim_rpc_server')
+    return s:pyeval('neovim_rpc_server.stats()')
 endfunc
 
 func! neovim_rpc#_on_stdout(job,data)
@@ -169,7 +310,7 @@ func! neovim_rpc#_on_close(job)
     endif
 endfunc
 
-func! neovim_rpc#_callback()
+func! neovim_rpc#_callback(...)
     execute g:neovim_rpc#py . ' neovim_rpc_server.process_pending_requests()'
 endfunc
 
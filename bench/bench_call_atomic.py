@@ -0,0 +1,43 @@
+# vim:set et sw=4 ts=8:
+#
+# 100 small calls from a client, one request each versus a single
+# nvim_call_atomic, through the server and the wakeups of vim's main loop.
+
+import benchutil
+import vim
+
+CALLS = [['nvim_get_var', ['bench_var']],
+         ['nvim_get_vvar', ['count']],
+         ['nvim_get_option', ['tabstop']],
+         ['nvim_set_var', ['bench_set', 1]]] * 25
+
+
+def main():
+    vim.vars['bench_var'] = 'value'
+    vim.vvars['count'] = 0
+    vim.options['tabstop'] = 8
+    loop, addr = benchutil.start_server()
+    client = benchutil.Client(addr)
+
+    def sequential():
+        for method, args in CALLS:
+            err, _ = client.request(method, args)
+            assert err is None, err
+
+    def atomic():
+        err, (results, error) = client.request('nvim_call_atomic', [CALLS])
+        assert err is None and error is None, (err, error)
+        assert len(results) == len(CALLS)
+
+    def in_loop(func):
+        return lambda: loop.run(benchutil.in_thread(func))
+
+    for name, func in [('%d requests' % len(CALLS), sequential),
+                       ('nvim_call_atomic', atomic)]:
+        elapsed = benchutil.best(in_loop(func), repeat=20)
+        print('%-20s %8.2f ms' % (name, elapsed * 1000))
+    client.close()
+
+
+if __name__ == '__main__':
+    main()
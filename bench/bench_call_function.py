@@ -0,0 +1,67 @@
+# vim:set et sw=4 ts=8:
+#
+# Calls per second of nvim_call_function for getline, line and exists, with
+# the cached vim.Function objects and with the g:_neovim_rpc_tmp_args and
+# call() expression they replaced. The stub vim does no work of its own, so
+# only the python side of either path is measured, vim parsing the call()
+# expression is not.
+
+import time
+
+import benchutil
+import vim
+
+import neovim_rpc_methods
+
+CALLS = [('getline', [1]), ('line', ['.']), ('exists', ['*Foo'])]
+DIRECT = 100000
+REQUESTS = 5000
+
+
+def rate(func, count):
+    start = time.time()
+    func(count)
+    return count / (time.time() - start)
+
+
+def main():
+    vim.current.buffer[:] = ['first line']
+    vim.functions.update({
+        'getline': lambda lnum: vim.current.buffer[lnum - 1],
+        'line': lambda expr: 1,
+        'exists': lambda expr: 0,
+    })
+    loop, addr = benchutil.start_server()
+    client = benchutil.Client(addr)
+    function = neovim_rpc_methods._function
+
+    def direct(name, args):
+        def run(count):
+            for _ in range(count):
+                neovim_rpc_methods.nvim_call_function(name, args)
+        return run
+
+    def requests(name, args):
+        def run(count):
+            def send():
+                for _ in range(count):
+                    err, _ = client.request('nvim_call_function',
+                                            [name, args])
+                    assert err is None, err
+            loop.run(benchutil.in_thread(send))
+        return run
+
+    print('%-10s %-10s %14s %14s' % ('', '', 'method/s', 'request/s'))
+    for path, lookup in [('Function', function),
+                         ('call()', lambda name: None)]:
+        neovim_rpc_methods._function = lookup
+        for name, args in CALLS:
+            print('%-10s %-10s %14d %14d' % (
+                path, name, rate(direct(name, args), DIRECT),
+                rate(requests(name, args), REQUESTS)))
+    neovim_rpc_methods._function = function
+    client.close()
+
+
+if __name__ == '__main__':
+    main()
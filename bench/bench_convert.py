@@ -0,0 +1,69 @@
+# vim:set et sw=4 ts=8:
+#
+# Converting rpc messages, the type dispatched from_client and the Packer
+# against the recursive walk they replaced, which called a closure on every
+# object of the message.
+
+import benchutil
+import msgpack
+import vim
+
+import neovim_rpc_protocol
+
+LINES = ['line %d' % i for i in range(50000)]
+
+
+def walk(fn, obj):
+    if type(obj) in [list, tuple, vim.List]:
+        return list(walk(fn, o) for o in obj)
+    if type(obj) in [dict, vim.Dictionary]:
+        return dict((walk(fn, k), walk(fn, v)) for k, v in
+                    obj.items())
+    return fn(obj)
+
+
+def walk_from_client(msg):
+    def handler(obj):
+        if type(obj) is neovim_rpc_protocol.Handle:
+            return vim.buffers[obj.number]
+        return neovim_rpc_protocol.decode_if_bytes(obj)
+    return walk(handler, msg)
+
+
+def walk_to_client(msg):
+    def handler(obj):
+        if type(obj) == neovim_rpc_protocol.BUFFER_TYPE:
+            return msgpack.ExtType(neovim_rpc_protocol.BUFFER_TYPE_ID,
+                                   msgpack.packb(obj.number))
+        if type(obj) == vim.Function:
+            return obj.name.encode()
+        return obj
+    return msgpack.packb(walk(handler, msg))
+
+
+def main():
+    neovim_rpc_protocol.init()
+    packer = neovim_rpc_protocol.Packer()
+    request = [0, 1, 'nvim_buf_set_lines',
+               [neovim_rpc_protocol.Handle(neovim_rpc_protocol.BUFFER_TYPE_ID,
+                                           1),
+                0, -1, False, LINES]]
+    response = [1, 1, None, LINES]
+    vim_response = [1, 1, None, vim.List(LINES)]
+    cases = [
+        ('request', walk_from_client, neovim_rpc_protocol.from_client,
+         request),
+        ('response', walk_to_client, packer.pack, response),
+        ('vim.List response', walk_to_client, packer.pack, vim_response),
+    ]
+    print('%d lines' % len(LINES))
+    print('%-20s %10s %10s' % ('', 'walk', 'now'))
+    for name, old, new, msg in cases:
+        old_time = benchutil.best(lambda: old(msg))
+        new_time = benchutil.best(lambda: new(msg))
+        print('%-20s %8.2f ms %7.2f ms' % (name, old_time * 1000,
+                                           new_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+# vim:set et sw=4 ts=8:
+#
+# Peak RSS of packing a large eval result, e.g. getline(1, '$') of a big log
+# file, streamed from the vim.List by the Packer and copied into a python
+# list first like to_client used to. Each case runs in its own process, so
+# that the peaks don't hide each other.
+
+import subprocess
+import sys
+
+import benchutil
+import msgpack
+import vim
+
+
+class ProxyList(vim.List):
+    """Like vim's List proxy, every item is created as a new python string
+    when it is visited, from lines that vim keeps as bytes."""
+
+    def __init__(self, lines):
+        list.__init__(self)
+        self._lines = lines
+
+    def __len__(self):
+        return len(self._lines)
+
+    def __iter__(self):
+        for line in self._lines:
+            yield line.decode('utf-8')
+
+
+def run(case, count):
+    # the Packer dispatches on vim.List, replace it before the import
+    vim.List = ProxyList
+    import neovim_rpc_protocol
+    neovim_rpc_protocol.init()
+    result = ProxyList([b'line %08d of a big log file ................' % i
+                        for i in range(count)])
+    before = benchutil.peak_rss_mb()
+    if case == 'list':
+        out = msgpack.packb([1, 1, None, list(result)])
+    else:
+        out = neovim_rpc_protocol.Packer().pack([1, 1, None, result])
+    print('%.1f %.1f' % (benchutil.peak_rss_mb() - before, len(out) / 1e6))
+
+
+def main():
+    print('%10s %10s %12s %12s' % ('lines', 'out MB', 'list() MB',
+                                   'streamed MB'))
+    for count in [200000, 1000000, 4000000]:
+        peaks = []
+        for case in ['list', 'stream']:
+            out = subprocess.check_output(
+                [sys.executable, __file__, case, str(count)])
+            peak, size = out.decode().split()
+            peaks.append(float(peak))
+        print('%10d %10s %12.1f %12.1f' % (count, size, peaks[0], peaks[1]))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3:
+        run(sys.argv[1], int(sys.argv[2]))
+    else:
+        main()
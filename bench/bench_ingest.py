@@ -0,0 +1,95 @@
+# vim:set et sw=4 ts=8:
+#
+# Throughput of the client socket thread for large requests: 5 MB
+# nvim_buf_set_lines notifications are sent until they are all unpacked and
+# queued for the main thread. The first row reads like SocketToStream used
+# to, 4096 bytes per recv into a file-like Unpacker.
+
+import socket
+import threading
+import time
+
+import benchutil
+import msgpack
+
+COUNT = 20
+
+
+def payload():
+    return msgpack.packb([2, 'nvim_buf_set_lines',
+                          [1, 0, -1, False, ['x' * 80] * 65000]])
+
+
+class SocketToStream():
+
+    def __init__(self, sock):
+        self._sock = sock
+
+    def read(self, cnt):
+        if cnt > 4096:
+            cnt = 4096
+        return self._sock.recv(cnt)
+
+
+def socket_to_stream(data):
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    client = socket.create_connection(server.getsockname())
+    sock = server.accept()[0]
+    done = threading.Event()
+
+    def read():
+        received = 0
+        for _ in msgpack.Unpacker(SocketToStream(sock), raw=False):
+            received += 1
+            if received == COUNT:
+                break
+        done.set()
+
+    thread = threading.Thread(target=read)
+    thread.daemon = True
+    thread.start()
+    start = time.time()
+    for _ in range(COUNT):
+        client.sendall(data)
+    done.wait()
+    elapsed = time.time() - start
+    client.close()
+    sock.close()
+    server.close()
+    return elapsed
+
+
+def server(addr, data, read_size):
+    import neovim_rpc_server
+    neovim_rpc_server._read_size = read_size
+    queue = neovim_rpc_server.request_queue
+    client = benchutil.Client(addr)
+    start = time.time()
+    for _ in range(COUNT):
+        client.sock.sendall(data)
+    while queue.qsize() < COUNT:
+        time.sleep(0.001)
+    elapsed = time.time() - start
+    while not queue.empty():
+        queue.get_nowait()
+    client.close()
+    return elapsed
+
+
+def main():
+    data = payload()
+    size = len(data) * COUNT / 1e6
+    loop, addr = benchutil.start_server()
+    print('%d x %.1f MB' % (COUNT, len(data) / 1e6))
+    print('%-28s %8.1f MB/s' % ('SocketToStream 4096',
+                                size / socket_to_stream(data)))
+    for read_size in [4096, 64 * 1024, 256 * 1024, 1024 * 1024]:
+        elapsed = min(server(addr, data, read_size) for _ in range(3))
+        print('%-28s %8.1f MB/s' % ('recv_into %d' % read_size,
+                                    size / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# vim:set et sw=4 ts=8:
+#
+# Decoding a rpcrequest of the vim json channel with multi-megabyte arguments,
+# fed in recv sized chunks. JsonStream should stay linear, unlike re-parsing
+# the whole buffer after every chunk as VimHandler used to.
+
+import json
+
+import benchutil
+from neovim_rpc_server import JsonStream
+
+CHUNK = 64 * 1024
+
+
+def message(size):
+    line = 'x' * 99
+    args = [line] * (size // 100)
+    return (json.dumps([1, ['rpcrequest', 1, 'method', args, '1']]) +
+            '\n').encode('utf-8')
+
+
+def chunks(data):
+    return [data[i:i + CHUNK] for i in range(0, len(data), CHUNK)]
+
+
+def json_stream(parts):
+    stream = JsonStream()
+    for part in parts:
+        msgs = stream.feed(part)
+    assert len(msgs) == 1
+
+
+def reparse(parts):
+    # the decoding loop VimHandler.handle used before JsonStream
+    data = None
+    for part in parts:
+        data = data + part if data else part
+        try:
+            json.loads(data.decode('utf-8'))
+        except ValueError:
+            continue
+        data = None
+    assert data is None
+
+
+def main():
+    print('%8s %12s %10s %12s' % ('MB', 'JsonStream', 'MB/s', 'reparse'))
+    for mb in [1, 2, 5, 21, 84]:
+        parts = chunks(message(mb * 1024 * 1024))
+        new = benchutil.best(lambda: json_stream(parts), 3)
+        old = '-'
+        if mb <= 5:
+            # quadratic, too slow for the larger sizes
+            old = '%.3f s' % benchutil.best(lambda: reparse(parts), 1)
+        print('%8d %10.3f s %10.1f %12s' % (mb, new, mb / new, old))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+# vim:set et sw=4 ts=8:
+#
+# nvim_buf_set_lines with g:neovim_rpc_set_lines_diff on 100000 line buffers
+# with 10 edits, e.g. a formatter or a plugin rewriting the whole buffer.
+# Reports the time and how many lines were assigned to the buffer, the
+# fewer the more of undo, marks and text properties survives.
+
+import random
+import time
+
+import benchutil  # noqa: F401, sets up the paths and the stub vim
+import vim
+
+import neovim_rpc_methods
+
+LINES = 100000
+EDITS = 10
+
+
+class Buffer(vim.Buffer):
+    """Counts the lines written by slice assignments."""
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            self.written += len(value)
+            self.deleted += len(range(*index.indices(len(self))))
+        vim.Buffer.__setitem__(self, index, value)
+
+
+def unique(rng):
+    return ['%06d 2026-10-18 12:00:00 request %d' % (i, rng.randrange(1000))
+            for i in range(LINES)]
+
+
+def csv(rng):
+    return ['%d,%s' % (rng.randrange(10), rng.choice('abcde'))
+            for _ in range(LINES)]
+
+
+def flags(rng):
+    return [rng.choice(['yes', 'no', '']) for _ in range(LINES)]
+
+
+def code(rng):
+    # blank lines and a few repeated lines between unique ones
+    lines = []
+    for i in range(LINES):
+        kind = rng.randrange(4)
+        if kind == 0:
+            lines.append('')
+        elif kind == 1:
+            lines.append('    end')
+        else:
+            lines.append('    call s:step(%d)' % i)
+    return lines
+
+
+def edit(rng, lines):
+    lines = list(lines)
+    for _ in range(EDITS):
+        pos = rng.randrange(len(lines))
+        op = rng.randrange(3)
+        if op == 0:
+            lines[pos] = 'changed %d' % pos
+        elif op == 1:
+            lines.insert(pos, 'inserted %d' % pos)
+        else:
+            del lines[pos]
+    return lines
+
+
+def main():
+    vim.vars['neovim_rpc_set_lines_diff'] = 1
+    print('%-8s %10s %10s %10s' % ('', 'seconds', 'written', 'deleted'))
+    for name, make in [('unique', unique), ('csv', csv), ('flags', flags),
+                       ('code', code)]:
+        rng = random.Random(1)
+        old = make(rng)
+        new = edit(rng, old)
+        buf = Buffer(1, old)
+        buf.written = buf.deleted = 0
+        start = time.time()
+        neovim_rpc_methods.nvim_buf_set_lines(buf, 0, -1, False, new)
+        elapsed = time.time() - start
+        assert list(buf) == new
+        print('%-8s %10.3f %10d %10d' % (name, elapsed, buf.written,
+                                         buf.deleted))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+# vim:set et sw=4 ts=8:
+#
+# Shared setup of the benchmarks, import it before anything from pythonx.
+
+import json
+import os
+import resource
+import select
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[0:0] = [_DIR, os.path.join(_DIR, '..', 'pythonx')]
+# keep the api info cache of the benchmarks out of ~/.cache
+os.environ['XDG_CACHE_HOME'] = tempfile.mkdtemp(prefix='neovim_rpc_bench')
+
+import msgpack  # noqa: E402
+import vim  # noqa: E402
+
+
+def best(func, repeat=5):
+    """The fastest of repeat runs of func(), in seconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def peak_rss_mb():
+    # kilobytes on linux, bytes on macos
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss /= 1024
+    return rss / 1024.0
+
+
+def start_server(**options):
+    """Start the servers like neovim_rpc#serveraddr() does, returns a VimLoop
+    connected to the vim control socket and the client server address."""
+    import neovim_rpc_server
+    vim.server_options.update(options)
+    vim.server_options['tempname'] = tempfile.mktemp(prefix='neovim_rpc_bench')
+    nvim_addr, vim_addr = neovim_rpc_server.start()
+    loop = VimLoop(vim_addr)
+    return loop, nvim_addr
+
+
+class VimLoop():
+    """Plays vim's main loop: processes the queued requests whenever the
+    server sends the `ex` wakeup over the json channel."""
+
+    def __init__(self, addr):
+        host, port = addr.split(':')
+        self.sock = socket.create_connection((host, int(port)))
+        self.sock.sendall(json.dumps([1, 'neovim_rpc_setup']).encode() +
+                          b'\n')
+        self._decoder = json.JSONDecoder()
+        self._buf = ''
+
+    def run(self, until, timeout=60):
+        import neovim_rpc_server
+        deadline = time.time() + timeout
+        while not until():
+            if time.time() > deadline:
+                raise Exception('timed out')
+            readable = select.select([self.sock], [], [], 0.001)[0]
+            if not readable:
+                continue
+            self._buf += self.sock.recv(65536).decode('utf-8')
+            while self._buf:
+                try:
+                    msg, idx = self._decoder.raw_decode(self._buf)
+                except ValueError:
+                    break
+                self._buf = self._buf[idx:].lstrip()
+                if msg[0] == 'ex':
+                    neovim_rpc_server.process_pending_requests()
+
+
+class Client():
+    """A msgpack-rpc client of the server, like a remote plugin."""
+
+    def __init__(self, addr):
+        if ':' in addr:
+            host, port = addr.split(':')
+            self.sock = socket.create_connection((host, int(port)))
+        else:
+            self.sock = socket.socket(socket.AF_UNIX)
+            self.sock.connect(addr)
+        self._unpacker = msgpack.Unpacker(raw=False,
+                                          max_buffer_size=1 << 31)
+        self._reqid = 0
+
+    def send(self, msg):
+        self.sock.sendall(msgpack.packb(msg))
+
+    def receive(self):
+        while True:
+            for msg in self._unpacker:
+                return msg
+            data = self.sock.recv(1 << 20)
+            if not data:
+                raise Exception('connection closed')
+            self._unpacker.feed(data)
+
+    def request(self, method, args):
+        self._reqid += 1
+        self.send([0, self._reqid, method, args])
+        while True:
+            msg = self.receive()
+            if msg[0] == 1 and msg[1] == self._reqid:
+                return msg[2], msg[3]
+
+    def close(self):
+        self.sock.close()
+
+
+def in_thread(func):
+    """Run func in a daemon thread, returns a function telling whether it
+    has finished."""
+    thread = threading.Thread(target=func)
+    thread.daemon = True
+    thread.start()
+    return lambda: not thread.is_alive()
@@ -0,0 +1,76 @@
+# vim:set et sw=4 ts=8:
+#
+# Not a benchmark: checks the coalescing of the listener_add() changes sent
+# as nvim_buf_lines_event. Random edits are made to random buffers, their
+# changes coalesced by _coalesce_changes, and the resulting ranges replayed,
+# in order, on the original lines like a client does. The replay has to end
+# up with the edited lines.
+#
+# Vim flushes the pending changes before one that adds or deletes lines
+# above an earlier one, with `--any` sequences vim doesn't report are
+# generated as well.
+
+import random
+import sys
+
+import benchutil  # noqa: F401, sets up the paths and the stub vim
+
+import neovim_rpc_server
+
+SEQUENCES = 20000
+
+
+def changes_of(rng, text, vim_rule):
+    """Edits text in place, returns the listener_add() changes."""
+    changes = []
+    for n in range(rng.randint(1, 6)):
+        lnum = rng.randint(1, len(text) + 1)
+        end = rng.randint(lnum, len(text) + 1)
+        if lnum == len(text) + 1:
+            # appended below the last line
+            end = lnum
+        count = rng.randint(0, 3)
+        added = count - (end - lnum)
+        if (vim_rule and added and
+                any(lnum <= change['lnum'] for change in changes)):
+            break
+        text[lnum - 1:end - 1] = ['new %d.%d' % (n, i) for i in range(count)]
+        changes.append({'lnum': lnum, 'end': end, 'added': added})
+    return changes
+
+
+def replay(lines, text, ranges):
+    """Applies the ranges like buf_lines_changed() sends them."""
+    lines = list(lines)
+    for lnum, end, added in ranges:
+        count = end - lnum + added
+        lines[lnum - 1:end - 1] = (text[lnum - 1:lnum - 1 + count]
+                                   if count > 0 else [])
+    return lines
+
+
+def main():
+    vim_rule = '--any' not in sys.argv[1:]
+    rng = random.Random(3)
+    changes_total = ranges_total = 0
+    for _ in range(SEQUENCES):
+        lines = ['line %d' % i for i in range(rng.randint(1, 15))]
+        text = list(lines)
+        changes = changes_of(rng, text, vim_rule)
+        ranges = neovim_rpc_server._coalesce_changes(changes)
+        replayed = replay(lines, text, ranges)
+        if replayed != text:
+            print('lines:    %s' % lines)
+            print('changes:  %s' % changes)
+            print('ranges:   %s' % ranges)
+            print('expected: %s' % text)
+            print('replayed: %s' % replayed)
+            sys.exit(1)
+        changes_total += len(changes)
+        ranges_total += len(ranges)
+    print('ok, %d sequences, %d changes sent as %d ranges' % (
+        SEQUENCES, changes_total, ranges_total))
+
+
+if __name__ == '__main__':
+    main()
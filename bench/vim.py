@@ -0,0 +1,127 @@
+# vim:set et sw=4 ts=8:
+#
+# Stand-in for vim's python module, so that the benchmarks run outside of
+# vim. Only what the server and neovim_rpc_methods touch is provided.
+# Vim functions are python callables registered in `functions`.
+
+import re
+
+
+class error(Exception):
+    pass
+
+
+class List(list):
+    pass
+
+
+class Dictionary(dict):
+    pass
+
+
+class Buffer(list):
+
+    def __init__(self, number, lines=None):
+        list.__init__(self, lines or [''])
+        self.number = number
+        self.valid = True
+        self.name = ''
+        self.vars = {}
+        self.options = {}
+
+
+class TabPage(object):
+
+    def __init__(self, number):
+        self.number = number
+        self.windows = []
+        self.valid = True
+
+
+class Window(object):
+
+    def __init__(self, number, buffer, tabpage):
+        self.number = number
+        self.buffer = buffer
+        self.tabpage = tabpage
+        self.valid = True
+        self.vars = {}
+        self.options = {}
+        self.cursor = (1, 0)
+
+
+class Function(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, *args):
+        func = functions.get(self.name)
+        if func is None:
+            return None
+        return func(*args)
+
+
+class _Current(object):
+    pass
+
+
+buffers = {1: Buffer(1)}
+tabpages = [TabPage(1)]
+windows = [Window(1, buffers[1], tabpages[0])]
+tabpages[0].windows = windows
+current = _Current()
+current.buffer = buffers[1]
+current.window = windows[0]
+current.line = ''
+vars = {}
+vvars = {}
+options = {}
+
+# name -> python callable
+functions = {}
+commands = []
+
+# what neovim_rpc#_server_options() returns, vim.eval gives strings
+server_options = {
+    'read_size': '65536',
+    'server_mode': 'thread',
+    'channel_max_messages': '10000',
+    'channel_max_bytes': str(256 * 1024 * 1024),
+    'full_api_info': '0',
+    'tempname': '',
+}
+
+_get = re.compile(r"get\(g:, '(\w+)', ([^)]+)\)")
+_call = re.compile(r'call\("(\w+)",g:(\w+)\)$')
+
+
+def eval(expr):
+    if expr == 'neovim_rpc#_server_options()':
+        return dict(server_options)
+    if expr == 'g:neovim_rpc#py':
+        return 'python3'
+    if expr.startswith('has('):
+        return '1'
+    if expr.startswith('[get(g:'):
+        return [str(vars.get(name, default))
+                for name, default in _get.findall(expr)]
+    if expr.startswith('get(g:'):
+        name, default = _get.findall(expr)[0]
+        return str(vars.get(name, default))
+    if expr == 'getchar(1)':
+        return '0'
+    if expr.startswith('bufwinnr('):
+        return '1'
+    match = _call.match(expr)
+    if match:
+        return Function(match.group(1))(*vars[match.group(2)])
+    raise error('stub vim can not eval: %s' % expr)
+
+
+def bindeval(expr):
+    return eval(expr)
+
+
+def command(cmd):
+    commands.append(cmd)
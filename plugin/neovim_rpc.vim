@@ -0,0 +1,11 @@
+if exists('g:loaded_neovim_rpc')
+    finish
+endif
+let g:loaded_neovim_rpc = 1
+
+if get(g:, 'neovim_rpc_warmup', 0)
+    augroup neovim_rpc_warmup
+        autocmd!
+        autocmd VimEnter * call neovim_rpc#_warmup()
+    augroup END
+endif
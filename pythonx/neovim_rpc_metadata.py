@@ -0,0 +1,143 @@
+# vim:set et sw=4 ts=8:
+
+# nvim_get_api_info metadata, packed once and cached on disk, so that the
+# large neovim_rpc_server_api_info module is only imported when the plugin
+# changes.
+
+import hashlib
+import logging
+import os
+import threading
+import msgpack
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+_DIR = os.path.dirname(os.path.abspath(__file__))
+
+API_INFO_METHODS = set(['nvim_get_api_info', 'vim_get_api_info',
+                        b'nvim_get_api_info', b'vim_get_api_info'])
+
+# reentrant, building the trimmed api info may load the cache
+_lock = threading.RLock()
+_cache = None
+_implemented = None
+# advertise every function of API_INFO instead of only the implemented ones,
+# g:neovim_rpc_full_api_info
+full = False
+
+
+def cache_path():
+    base = os.environ.get('XDG_CACHE_HOME',
+                          os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'vim-hug-neovim-rpc',
+                        'api_info_%s.msgpack' % version())
+
+
+def version():
+    """Changes whenever any python file of the plugin does."""
+    sha = hashlib.sha1()
+    for name in sorted(os.listdir(_DIR)):
+        if not name.endswith('.py'):
+            continue
+        st = os.stat(os.path.join(_DIR, name))
+        sha.update(('%s:%d:%d;' % (name, st.st_size, st.st_mtime))
+                   .encode('utf-8'))
+    return sha.hexdigest()[:16]
+
+
+def _build():
+    import neovim_rpc_server_api_info
+    api_info = neovim_rpc_server_api_info.API_INFO
+    return dict(
+        api_info=msgpack.packb(api_info),
+        deprecated=[f['name'] for f in api_info['functions']
+                    if 'deprecated_since' in f],
+        types=dict((name, t['id']) for name, t in api_info['types'].items()),
+    )
+
+
+def _load():
+    global _cache
+    with _lock:
+        if _cache is not None:
+            return _cache
+        path = cache_path()
+        try:
+            with open(path, 'rb') as f:
+                _cache = msgpack.unpackb(f.read(), raw=False)
+            return _cache
+        except Exception as ex:
+            logger.info("api info cache [%s] not loaded: %s", path, ex)
+        _cache = _build()
+        _save(path, _cache)
+        # caches of other plugin versions are stale
+        try:
+            cache_dir = os.path.dirname(path)
+            for name in os.listdir(cache_dir):
+                if (name.startswith('api_info_') and
+                        name != os.path.basename(path)):
+                    os.unlink(os.path.join(cache_dir, name))
+        except Exception as ex:
+            logger.info("removing stale api info caches failed: %s", ex)
+        return _cache
+
+
+def _save(path, cache):
+    try:
+        cache_dir = os.path.dirname(path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(msgpack.packb(cache, use_bin_type=True))
+        if os.path.exists(path):
+            os.unlink(path)
+        os.rename(tmp, path)
+    except Exception as ex:
+        logger.info("api info cache [%s] not written: %s", path, ex)
+
+
+def set_implemented(names_func):
+    """names_func returns the rpc methods the server can dispatch, the
+    functions advertised by the trimmed api info. It is only called when the
+    trimmed api info is not cached yet."""
+    global _implemented
+    _implemented = names_func
+
+
+def _packed_api_info():
+    cache = _load()
+    if full:
+        return cache['api_info']
+    if 'api_info_trimmed' not in cache:
+        # built once per plugin version, since that is what the set of
+        # implemented methods depends on
+        with _lock:
+            implemented = set(_implemented())
+            api_info = msgpack.unpackb(cache['api_info'], raw=False)
+            api_info['functions'] = [f for f in api_info['functions']
+                                     if f['name'] in implemented]
+            cache['api_info_trimmed'] = msgpack.packb(api_info)
+            _save(cache_path(), cache)
+    return cache['api_info_trimmed']
+
+
+def api_info():
+    return msgpack.unpackb(_packed_api_info(), raw=False)
+
+
+def packed_api_info_response(reqid, channel):
+    """The msgpack encoded [1, reqid, nil, [channel, API_INFO]] response,
+    with the pre-packed metadata spliced in."""
+    # 0x94: array of 4, 0x01: response type, 0xc0: nil, 0x92: array of 2
+    return b''.join([b'\x94\x01', msgpack.packb(reqid), b'\xc0\x92',
+                     msgpack.packb(channel), _packed_api_info()])
+
+
+def deprecated_functions():
+    return _load()['deprecated']
+
+
+def type_id(name):
+    return _load()['types'][name]
@@ -1,10 +1,52 @@
 # vim:set et sw=4 ts=8:
+import bisect
+import collections
+import difflib
 import vim
 
-# vim's python binding doesn't have the `call` method, wrap it here
+# set by methods that change the screen, the server redraws once after a
+# batch of requests instead of once per call
+_redraw_pending = False
+
+
+def _request_redraw():
+    global _redraw_pending
+    _redraw_pending = True
+
+
+def _flush_redraw():
+    """Redraw if requested since the last flush, returns True if it did."""
+    global _redraw_pending
+    if not _redraw_pending:
+        return False
+    _redraw_pending = False
+    vim.command('redraw')
+    return True
+
+
+# vim.Function by name, so that calling a function needs neither a global
+# variable for the arguments nor parsing an expression
+_functions = {}
+
+
+def _function(name):
+    func = _functions.get(name)
+    if func is None:
+        try:
+            func = vim.Function(name)
+        except (ValueError, vim.error):
+            # e.g. script-local functions
+            return None
+        _functions[name] = func
+    return func
 
 
 def nvim_call_function(method, args):
+    func = _function(method)
+    if func is not None:
+        # unlike vim.eval, numbers are returned as numbers
+        return func(*args)
+    # vim's python binding doesn't have the `call` method, wrap it here
     vim.vars['_neovim_rpc_tmp_args'] = args
     # vim.eval('getcurpos()') return an array of string, it should be an array
     # of int.  Use json_encode to workaround this
@@ -31,6 +73,10 @@ def nvim_buf_get_name(buffer):
     return buffer.name
 
 
+def nvim_buf_is_valid(buffer):
+    return buffer.valid
+
+
 def nvim_get_var(name):
     return vim.vars[name]
 
@@ -61,7 +107,7 @@ def nvim_buf_get_lines(buffer, start, end, *args):
 
 
 def nvim_eval(expr):
-    return nvim_call_function('eval', [expr])
+    return vim.bindeval(expr)
 
 
 def nvim_buf_set_lines(buffer, start, end, err, lines):
@@ -69,16 +115,194 @@ def nvim_buf_set_lines(buffer, start, end, err, lines):
         start = len(buffer) + 1 + start
     if end < 0:
         end = len(buffer) + 1 + end
-    buffer[start:end] = lines
+
+    diff, max_ratio = vim.eval(
+        "[get(g:, 'neovim_rpc_set_lines_diff', 0),"
+        " get(g:, 'neovim_rpc_set_lines_diff_max_ratio', 0.5)]")
+    if int(diff):
+        _set_lines_diff(buffer, start, end, lines, float(max_ratio))
+    else:
+        buffer[start:end] = lines
 
     if nvim_call_function('bufwinnr', [buffer.number]) != -1:
         # vim needs' redraw to update the screen, it seems to be a bug
-        vim.command('redraw')
+        _request_redraw()
 
 
 buffer_set_lines = nvim_buf_set_lines
 
 
+def _set_lines_diff(buffer, start, end, lines, max_ratio):
+    """buffer[start:end] = lines, changing only the lines that differ, so
+    that undo, listeners, marks and text properties of the other lines are
+    kept.
+
+    Lines common to the start and the end are skipped, the rest is diffed
+    unless more than max_ratio of the lines have changed, e.g. when
+    everything is replaced, where diffing is expensive and doesn't save
+    anything.
+    """
+    old = buffer[start:end]
+    total = max(len(old), len(lines), 1)
+    size = min(len(old), len(lines))
+    head = 0
+    while head < size and old[head] == lines[head]:
+        head += 1
+    tail = 0
+    while (tail < size - head and
+           old[len(old) - 1 - tail] == lines[len(lines) - 1 - tail]):
+        tail += 1
+    old = old[head:len(old) - tail]
+    new = lines[head:len(lines) - tail]
+    start += head
+    if not old and not new:
+        return
+    if not old or not new or _changed(old, new) > max_ratio * total:
+        buffer[start:start + len(old)] = new
+        return
+    # from the end, so that the line numbers of earlier hunks stay valid
+    for i1, i2, j1, j2 in reversed(_hunks(old, new)):
+        buffer[start + i1:start + i2] = new[j1:j2]
+
+
+# the largest old lines x new lines gap given to difflib, whose cost grows
+# with the product when lines repeat
+_MAX_GAP = 500 * 500
+# lines of the runs anchoring the gaps of few distinct lines
+_WINDOW = 16
+
+
+def _hunks(old, new):
+    """The (i1, i2, j1, j2) ranges where old[i1:i2] has to be replaced by
+    new[j1:j2].
+
+    The longest run of lines that are unique in both and in the same order
+    anchors the diff, like patience diff. Only the gaps between anchors are
+    diffed with difflib, which is too slow for a whole large buffer. A gap
+    that is still too large, e.g. in a csv file of few distinct lines, is
+    anchored again by the runs of lines that are unique, then by pairing the
+    occurrences of its lines. What remains too large after that is replaced
+    as a whole.
+    """
+    hunks = []
+    _diff(old, new, 0, 0,
+          [_unique_pairs, _window_pairs, _occurrence_pairs], hunks)
+    return hunks
+
+
+def _diff(old, new, i0, j0, pairings, hunks):
+    if len(old) * len(new) <= _MAX_GAP:
+        matcher = difflib.SequenceMatcher(None, old, new, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag != 'equal':
+                hunks.append((i0 + i1, i0 + i2, j0 + j1, j0 + j2))
+        return
+    if not pairings:
+        hunks.append((i0, i0 + len(old), j0, j0 + len(new)))
+        return
+    anchors = _anchors(pairings[0](old, new))
+    anchors.append((len(old), len(new)))
+    i1 = j1 = 0
+    for i, j in anchors:
+        if i != i1 or j != j1:
+            _diff(old[i1:i], new[j1:j], i0 + i1, j0 + j1, pairings[1:],
+                  hunks)
+        i1, j1 = i + 1, j + 1
+
+
+def _unique_pairs(old, new):
+    """(i, j) of the lines found exactly once in old and in new."""
+    old_counts = collections.Counter(old)
+    new_counts = collections.Counter(new)
+    positions = dict((line, j) for j, line in enumerate(new)
+                     if new_counts[line] == 1)
+    return [(i, positions[line]) for i, line in enumerate(old)
+            if line in positions and old_counts[line] == 1]
+
+
+def _window_pairs(old, new):
+    """(i, j) of the lines starting a run of _WINDOW lines that is found
+    exactly once in old and in new."""
+    return _unique_pairs(_windows(old), _windows(new))
+
+
+def _windows(lines):
+    return [tuple(lines[i:i + _WINDOW]) for i in range(len(lines))]
+
+
+def _occurrence_pairs(old, new):
+    """(i, j) pairing the n-th occurrence of a line in old with its n-th
+    occurrence in new."""
+    positions = {}
+    for j, line in enumerate(new):
+        positions.setdefault(line, collections.deque()).append(j)
+    pairs = []
+    for i, line in enumerate(old):
+        js = positions.get(line)
+        if js:
+            pairs.append((i, js.popleft()))
+    return pairs
+
+
+def _anchors(pairs):
+    """The longest subsequence of pairs, ordered by i, whose j increase."""
+    # tails[k] is the smallest j ending an increasing run of length k + 1
+    tails = []
+    tail_pairs = []
+    prev = []
+    for p, (i, j) in enumerate(pairs):
+        if not tails or j > tails[-1]:
+            k = len(tails)
+            tails.append(j)
+            tail_pairs.append(p)
+        else:
+            k = bisect.bisect_left(tails, j)
+            tails[k] = j
+            tail_pairs[k] = p
+        prev.append(tail_pairs[k - 1] if k else -1)
+    anchors = []
+    p = tail_pairs[-1] if tail_pairs else -1
+    while p >= 0:
+        anchors.append(pairs[p])
+        p = prev[p]
+    anchors.reverse()
+    return anchors
+
+
+def _changed(old, new):
+    """Estimated number of changed lines, the larger count of old lines not
+    in new and new lines not in old."""
+    old_set = set(old)
+    new_set = set(new)
+    return max(sum(1 for line in old if line not in new_set),
+               sum(1 for line in new if line not in old_set))
+
+
+# deprecated single line api, a negative index counts from the end with -1
+# being the last line
+
+
+def _convert_index(index):
+    if index < 0:
+        return index - 1
+    return index
+
+
+def buffer_get_line(buffer, index):
+    index = _convert_index(index)
+    return nvim_buf_get_lines(buffer, index, index + 1)[0]
+
+
+def buffer_set_line(buffer, index, line):
+    index = _convert_index(index)
+    nvim_buf_set_lines(buffer, index, index + 1, True, [line])
+
+
+def buffer_del_line(buffer, index):
+    index = _convert_index(index)
+    nvim_buf_set_lines(buffer, index, index + 1, True, [])
+
+
 def buffer_line_count(buffer):
     return len(buffer)
 
@@ -1,12 +1,34 @@
 import sys
+import threading
 import vim
 import msgpack
-import neovim_rpc_server_api_info
+import neovim_rpc_metadata
 
-BUFFER_TYPE = type(vim.current.buffer)
-BUFFER_TYPE_ID = neovim_rpc_server_api_info.API_INFO['types']['Buffer']['id']
-WINDOW_TYPE = type(vim.current.window)
-WINDOW_TYPE_ID = neovim_rpc_server_api_info.API_INFO['types']['Window']['id']
+# set by init()
+BUFFER_TYPE = None
+BUFFER_TYPE_ID = neovim_rpc_metadata.type_id('Buffer')
+WINDOW_TYPE = None
+WINDOW_TYPE_ID = neovim_rpc_metadata.type_id('Window')
+from_client = None
+_to_client_handlers = {}
+
+
+def init():
+    """Resolve what depends on the running vim, called from the main thread
+    so that importing this module doesn't touch vim."""
+    global BUFFER_TYPE, WINDOW_TYPE, from_client
+    BUFFER_TYPE = type(vim.current.buffer)
+    WINDOW_TYPE = type(vim.current.window)
+    if int(vim.eval("has('patch-8.0.1280')")):
+        from_client = _make_from_client()
+    else:
+        from_client = _make_from_client_none_as_empty()
+    _to_client_handlers.update({
+        BUFFER_TYPE: handles.encode_buffer,
+        WINDOW_TYPE: handles.encode_window,
+        vim.Function: _function_to_client,
+        InvalidHandle: _invalid_to_client,
+    })
 
 
 def decode_if_bytes(obj):
@@ -15,55 +37,351 @@ def decode_if_bytes(obj):
     return obj
 
 
-def walk(fn, obj):
-    if type(obj) in [list, tuple, vim.List]:
-        return list(walk(fn, o) for o in obj)
-    if type(obj) in [dict, vim.Dictionary]:
-        return dict((walk(fn, k), walk(fn, v)) for k, v in
-                    obj.items())
-    return fn(obj)
-
-
-if vim.eval("has('patch-8.0.1280')"):
-    def from_client(msg):
-        def handler(obj):
-            if type(obj) is msgpack.ExtType:
-                if obj.code == BUFFER_TYPE_ID:
-                    return vim.buffers[msgpack.unpackb(obj.data)]
-                if obj.code == WINDOW_TYPE_ID:
-                    return vim.windows[msgpack.unpackb(obj.data) - 1]
-            if sys.version_info.major != 2:
-                # python3 needs decode
-                obj = decode_if_bytes(obj)
-            return obj
-        return walk(handler, msg)
+if sys.version_info.major == 2:
+    _STRINGS = [str, unicode]  # noqa: F821
+    _INTEGERS = [int, long]  # noqa: F821
 else:
-    def from_client(msg):
-        def handler(obj):
-            if type(obj) is msgpack.ExtType:
-                if obj.code == BUFFER_TYPE_ID:
-                    return vim.buffers[msgpack.unpackb(obj.data)]
-                if obj.code == WINDOW_TYPE_ID:
-                    return vim.windows[msgpack.unpackb(obj.data) - 1]
-            elif obj is None:
-                return ''
-            if sys.version_info.major != 2:
-                # python3 needs decode
-                obj = decode_if_bytes(obj)
+    _STRINGS = [str, bytes]
+    _INTEGERS = [int]
+
+_SCALARS = frozenset(_STRINGS + _INTEGERS + [float, bool, type(None)])
+
+
+def _converter(handlers, passthrough):
+    """Build a function converting a message with the type -> function
+    handlers.
+
+    A container is only copied if one of its items needs conversion, which is
+    decided by the set of its item types. Containers of passthrough types
+    only, e.g. the lines of nvim_buf_get_lines, are returned as they are
+    without visiting every item in python.
+
+    vim.List and vim.Dictionary are always converted to list and dict.
+    """
+
+    def convert(obj):
+        handler = handlers.get(type(obj))
+        if handler is not None:
+            return handler(obj)
+        return obj
+
+    def convert_list(obj):
+        if set(map(type, obj)) <= passthrough:
             return obj
-        return walk(handler, msg)
+        return [convert(o) for o in obj]
 
+    def convert_dict(obj):
+        if (set(map(type, obj.values())) <= passthrough and
+                set(map(type, obj.keys())) <= passthrough):
+            return obj
+        return dict((convert(k), convert(v)) for k, v in obj.items())
 
-def to_client(msg):
-    def handler(obj):
-        if type(obj) == BUFFER_TYPE:
-            return msgpack.ExtType(BUFFER_TYPE_ID, msgpack.packb(obj.number))
-        if type(obj) == WINDOW_TYPE:
-            return msgpack.ExtType(WINDOW_TYPE_ID, msgpack.packb(obj.number))
-        if type(obj) == vim.Function:
-            try:
-                return obj.name.encode()
-            except Exception:
-                return ""
+    def convert_vim_list(obj):
+        return [convert(o) for o in obj]
+
+    def convert_vim_dict(obj):
+        return dict((convert(k), convert(v)) for k, v in obj.items())
+
+    handlers = dict(handlers)
+    handlers[list] = convert_list
+    handlers[tuple] = convert_list
+    handlers[dict] = convert_dict
+    handlers[vim.List] = convert_vim_list
+    handlers[vim.Dictionary] = convert_vim_dict
+    return convert
+
+
+class Handle(object):
+    """A Buffer or Window sent by the client. Created by the unpacker on the
+    socket thread, resolved to the vim object by from_client on the main
+    thread."""
+
+    __slots__ = ['code', 'number']
+
+    def __init__(self, code, number):
+        self.code = code
+        self.number = number
+
+    def __repr__(self):
+        return 'Handle(%s, %s)' % (self.code, self.number)
+
+
+def _ext_hook(code, data):
+    if code == BUFFER_TYPE_ID or code == WINDOW_TYPE_ID:
+        return Handle(code, msgpack.unpackb(data))
+    return msgpack.ExtType(code, data)
+
+
+def unpacker():
+    """msgpack.Unpacker for client sockets, strings are decoded and handles
+    created while unpacking, so that from_client only has to resolve the
+    handles.
+
+    Strings that aren't valid utf-8 are decoded with surrogateescape, as vim
+    does for python3, so that they reach vim as the bytes the client sent
+    instead of failing the whole channel."""
+    if sys.version_info.major == 2:
+        # str is bytes anyway
+        return msgpack.Unpacker(ext_hook=_ext_hook)
+    try:
+        return msgpack.Unpacker(raw=False, unicode_errors='surrogateescape',
+                                ext_hook=_ext_hook)
+    except TypeError:
+        # msgpack < 0.5.2
+        return msgpack.Unpacker(encoding='utf-8',
+                                unicode_errors='surrogateescape',
+                                ext_hook=_ext_hook)
+
+
+class InvalidHandle(object):
+    """A buffer number or window id the client sent that doesn't exist
+    (anymore). As in neovim, nvim_buf_is_valid and nvim_win_is_valid return
+    false for it and every other use fails with an error."""
+
+    valid = False
+
+    def __init__(self, code, number):
+        self._code = code
+        self._number = number
+
+    def _invalid(self, *args):
+        kind = 'buffer' if self._code == BUFFER_TYPE_ID else 'window'
+        raise Exception('Invalid %s id: %s' % (kind, self._number))
+
+    def __getattr__(self, name):
+        self._invalid()
+
+    __len__ = __iter__ = __getitem__ = __setitem__ = __delitem__ = _invalid
+
+    def __repr__(self):
+        return 'InvalidHandle(%s, %s)' % (self._code, self._number)
+
+
+class HandleRegistry():
+    """Buffers and windows exchanged with clients.
+
+    A Buffer is identified by its number and a Window by its window-id, like
+    neovim does, so that windows of other tab pages can be referred to. The
+    vim objects and their ExtType encodings are cached, entries are dropped
+    by the BufWipeout and WinClosed autocmds, see neovim_rpc#serveraddr().
+
+    Only used on vim's main thread.
+    """
+
+    def __init__(self):
+        # bufnr -> (Buffer, ExtType)
+        self._buffers = {}
+        # winid -> (Window, ExtType)
+        self._windows = {}
+        # id(Window) -> winid, the Window is kept alive by _windows
+        self._window_ids = {}
+
+    def _buffer_entry(self, bufnr):
+        entry = self._buffers.get(bufnr)
+        if entry is None:
+            entry = (vim.buffers[bufnr],
+                     msgpack.ExtType(BUFFER_TYPE_ID, msgpack.packb(bufnr)))
+            self._buffers[bufnr] = entry
+        return entry
+
+    def encode_buffer(self, buf):
+        return self._buffer_entry(buf.number)[1]
+
+    def buffer(self, bufnr):
+        if bufnr == 0:
+            # the current buffer, as in neovim
+            return vim.current.buffer
+        entry = self._buffers.get(bufnr)
+        if entry is not None and entry[0].valid:
+            return entry[0]
+        self.forget_buffer(bufnr)
+        try:
+            return self._buffer_entry(bufnr)[0]
+        except KeyError:
+            return InvalidHandle(BUFFER_TYPE_ID, bufnr)
+
+    def _add_window(self, win, winid):
+        entry = (win, msgpack.ExtType(WINDOW_TYPE_ID, msgpack.packb(winid)))
+        self._windows[winid] = entry
+        self._window_ids[id(win)] = winid
+        return entry
+
+    def encode_window(self, win):
+        winid = self._window_ids.get(id(win))
+        if winid is None:
+            winid = int(vim.eval('win_getid(%d, %d)' %
+                                 (win.number, win.tabpage.number)))
+            return self._add_window(win, winid)[1]
+        return self._windows[winid][1]
+
+    def window(self, winid):
+        if winid == 0:
+            return vim.current.window
+        entry = self._windows.get(winid)
+        if entry is not None and entry[0].valid:
+            return entry[0]
+        if entry is not None:
+            # WinClosed is not available in older vim
+            self.forget_window(winid)
+        tabnr, winnr = vim.eval('win_id2tabwin(%d)' % winid)
+        tabnr, winnr = int(tabnr), int(winnr)
+        if not tabnr:
+            return InvalidHandle(WINDOW_TYPE_ID, winid)
+        win = vim.tabpages[tabnr - 1].windows[winnr - 1]
+        return self._add_window(win, winid)[0]
+
+    def forget_buffer(self, bufnr):
+        self._buffers.pop(bufnr, None)
+
+    def forget_window(self, winid):
+        entry = self._windows.pop(winid, None)
+        if entry is not None:
+            self._window_ids.pop(id(entry[0]), None)
+
+
+handles = HandleRegistry()
+
+
+def _handle_from_client(obj):
+    if obj.code == BUFFER_TYPE_ID:
+        return handles.buffer(obj.number)
+    return handles.window(obj.number)
+
+
+def _from_client_handlers():
+    handlers = {Handle: _handle_from_client}
+    passthrough = set(_SCALARS)
+    if sys.version_info.major != 2:
+        # msgpack bin type, str is decoded by the unpacker already
+        handlers[bytes] = decode_if_bytes
+        passthrough.discard(bytes)
+    return handlers, passthrough
+
+
+def _make_from_client():
+    handlers, passthrough = _from_client_handlers()
+    return _converter(handlers, frozenset(passthrough))
+
+
+def _make_from_client_none_as_empty():
+    # vim without patch-8.0.1280 doesn't accept None
+    handlers, passthrough = _from_client_handlers()
+    handlers[type(None)] = lambda obj: ''
+    passthrough.discard(type(None))
+    return _converter(handlers, frozenset(passthrough))
+
+
+def _decode_vim_string(obj):
+    try:
+        return obj.decode('utf-8')
+    except UnicodeDecodeError:
+        # not text, sent as msgpack bin
         return obj
-    return walk(handler, msg)
+
+
+def _make_from_vim():
+    if sys.version_info.major == 2:
+        return _converter({}, _SCALARS)
+    return _converter({bytes: _decode_vim_string}, _SCALARS - set([bytes]))
+
+
+# converts what python gets from vim.vars and vim.bindeval, where vim strings
+# are bytes in python3, like the json channel would
+from_vim = _make_from_vim()
+
+
+def _function_to_client(obj):
+    try:
+        return obj.name.encode()
+    except Exception:
+        return ""
+
+
+def _invalid_to_client(obj):
+    return msgpack.ExtType(obj._code, msgpack.packb(obj._number))
+
+
+def _default(obj):
+    """The Packer's hook for what msgpack can't pack by itself."""
+    handler = _to_client_handlers.get(type(obj))
+    if handler is None:
+        raise TypeError('can not serialize %r' % obj)
+    return handler(obj)
+
+
+class Packer():
+    """Packs the messages sent to a client channel, reusing one
+    msgpack.Packer.
+
+    vim.List and vim.Dictionary are streamed into the packer's buffer item
+    by item, e.g. the result of getline(1, '$') is never copied into a
+    python list. Python containers without vim containers inside are packed
+    by msgpack directly, other vim objects are converted by the default hook
+    as the packer meets them.
+
+    May be used from any thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._packer = msgpack.Packer(default=_default, autoreset=False)
+
+    def pack(self, msg):
+        with self._lock:
+            try:
+                self._pack(msg)
+                return self._packer.bytes()
+            except UnicodeEncodeError:
+                # a string the unpacker decoded with surrogateescape, packed
+                # as the bytes it came from. The fast path stays strict,
+                # msgpack packs slower with unicode_errors set.
+                self._packer.reset()
+                return self._pack_escaped(msg)
+            finally:
+                self._packer.reset()
+
+    def _pack_escaped(self, msg):
+        packer = self._packer
+        self._packer = msgpack.Packer(default=_default, autoreset=False,
+                                      unicode_errors='surrogateescape')
+        try:
+            self._pack(msg)
+            return self._packer.bytes()
+        finally:
+            self._packer = packer
+
+    def _pack(self, obj):
+        packer = self._packer
+        t = type(obj)
+        if t is vim.List:
+            packer.pack_array_header(len(obj))
+            for item in obj:
+                if type(item) in _SCALARS:
+                    packer.pack(item)
+                else:
+                    self._pack(item)
+        elif t is vim.Dictionary:
+            packer.pack_map_header(len(obj))
+            for key in obj.keys():
+                packer.pack(key)
+                self._pack(obj[key])
+        elif t is list or t is tuple:
+            if _CONTAINERS.isdisjoint(map(type, obj)):
+                packer.pack(obj)
+                return
+            packer.pack_array_header(len(obj))
+            for item in obj:
+                self._pack(item)
+        elif t is dict:
+            if _CONTAINERS.isdisjoint(map(type, obj.values())):
+                packer.pack(obj)
+                return
+            packer.pack_map_header(len(obj))
+            for key, value in obj.items():
+                packer.pack(key)
+                self._pack(value)
+        else:
+            packer.pack(obj)
+
+
+# types that may hold vim containers
+_CONTAINERS = frozenset([list, tuple, dict, vim.List, vim.Dictionary])
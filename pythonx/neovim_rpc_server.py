@@ -1,25 +1,30 @@
 # vim:set et sw=4 ts=8:
 
+import collections
+import errno
 import json
 import socket
 import sys
 import os
 import threading
+import time
 import vim
 import logging
-import msgpack
-import neovim_rpc_server_api_info
+import neovim_rpc_metadata
 import neovim_rpc_methods
 import neovim_rpc_protocol
+import neovim_rpc_warmup
 
-vim_error = vim.Function('neovim_rpc#_error')
-vim_py = vim.eval('g:neovim_rpc#py')
+# set by start(), importing this module doesn't touch vim
+vim_error = None
+vim_on_async_response = None
+vim_py = None
 
 
 if sys.version_info.major == 2:
-    from Queue import Queue, Empty as QueueEmpty
+    from Queue import Empty as QueueEmpty
 else:
-    from queue import Queue, Empty as QueueEmpty
+    from queue import Empty as QueueEmpty
 
 # NVIM_PYTHON_LOG_FILE=nvim.log NVIM_PYTHON_LOG_LEVEL=INFO vim test.md
 
@@ -30,15 +35,190 @@ except ImportError:
     # Python 2
     import SocketServer as socketserver
 
+try:
+    import selectors
+except ImportError:
+    # Python 2, only the threaded server mode is available
+    selectors = None
+
+_clock = getattr(time, 'monotonic', time.time)
+
 # globals
 logger = logging.getLogger(__name__)
 # supress the annoying error message:
 #     No handlers could be found for logger "neovim_rpc_server"
 logger.addHandler(logging.NullHandler())
 
-request_queue = Queue()
+
+class RequestScheduler():
+    """Queue of client messages waiting for vim's main thread.
+
+    Every channel has its own FIFO, so the order of one client's messages is
+    kept. Channels are served round-robin, and channels whose next message
+    is a request (or a response of rpcrequest_async) are served before
+    channels whose next message is a notification, so that a client blocking
+    on a request is not stuck behind another client's flood of
+    notifications.
+
+    Items are (writer, channel, msg) tuples.
+
+    A channel exceeding max_messages or max_bytes (0 for no limit) is
+    expected to stop reading from its socket, see pause_if_full.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queues = {}
+        # queued bytes per channel
+        self._bytes = {}
+        # channels with queued messages, in round-robin order
+        self._ring = collections.deque()
+        self._size = 0
+        # resume callbacks of the channels that stopped reading
+        self._paused = {}
+        self.max_messages = 0
+        self.max_bytes = 0
+
+    def put(self, item, size=0):
+        channel = item[1]
+        with self._lock:
+            queue = self._queues.get(channel)
+            if queue is None:
+                queue = self._queues[channel] = collections.deque()
+                self._bytes[channel] = 0
+            if not queue:
+                self._ring.append(channel)
+            queue.append((item, size))
+            self._bytes[channel] += size
+            self._size += 1
+
+    def pause_if_full(self, channel, on_resume):
+        """Returns True if the channel is over its limits, and its reader
+        should stop reading until on_resume is called."""
+        with self._lock:
+            if not self._over_limit(channel, 1):
+                return False
+            self._paused[channel] = on_resume
+        _stat_add('read_stalls')
+        logger.info("channel[%s] queue full, stop reading", channel)
+        return True
+
+    def _over_limit(self, channel, fraction):
+        queue = self._queues.get(channel)
+        if not queue:
+            return False
+        return ((self.max_messages > 0 and
+                 len(queue) > self.max_messages * fraction) or
+                (self.max_bytes > 0 and
+                 self._bytes[channel] > self.max_bytes * fraction))
+
+    def get_nowait(self):
+        with self._lock:
+            if not self._size:
+                raise QueueEmpty()
+            chosen = self._ring[0]
+            for channel in self._ring:
+                # notification type is 2
+                if self._queues[channel][0][0][2][0] != 2:
+                    chosen = channel
+                    break
+            self._ring.remove(chosen)
+            queue = self._queues[chosen]
+            item, size = queue.popleft()
+            self._bytes[chosen] -= size
+            if queue:
+                self._ring.append(chosen)
+            else:
+                del self._queues[chosen]
+                del self._bytes[chosen]
+            self._size -= 1
+            on_resume = None
+            # resume at half of the limits, to avoid stalling again on the
+            # next read
+            if (chosen in self._paused and
+                    not self._over_limit(chosen, 0.5)):
+                on_resume = self._paused.pop(chosen)
+        if on_resume is not None:
+            on_resume()
+        return item
+
+    def empty(self):
+        return self._size == 0
+
+    def qsize(self):
+        return self._size
+
+    def depths(self):
+        with self._lock:
+            return dict((channel, len(queue))
+                        for channel, queue in self._queues.items())
+
+    def queued_bytes(self):
+        with self._lock:
+            return dict(self._bytes)
+
+    def paused(self):
+        with self._lock:
+            return set(self._paused)
+
+
+request_queue = RequestScheduler()
 responses = {}
 
+# size of the buffer each client socket is read into, g:neovim_rpc_read_size
+_read_size = 64 * 1024
+# EventLoopServer when g:neovim_rpc_server_mode is 'selector'
+_event_loop = None
+# [client server, vim server] addresses, set by prepare()
+_addresses = None
+
+_stats_lock = threading.Lock()
+_stats = dict(
+    # ex wakeups sent to vim for processing request_queue
+    wakeups_sent=0,
+    # wakeups skipped because one was already in flight
+    wakeups_coalesced=0,
+    # process_pending_requests invocations
+    drains=0,
+    # messages taken from request_queue
+    messages_processed=0,
+    # drains that ran out of budget and were resumed by a timer
+    drains_cut_short=0,
+    # ChannelWriter flushes, each one is a single sendall
+    write_batches=0,
+    write_messages=0,
+    write_bytes=0,
+    # time from enqueueing the oldest message of a batch until it is sent
+    write_flush_ms_total=0,
+    write_flush_ms_max=0,
+    # times a channel stopped reading because its queue was full
+    read_stalls=0,
+    # redraws after processing requests, at most one per drain
+    redraws=0,
+)
+
+
+def _stat_add(name, value=1):
+    with _stats_lock:
+        _stats[name] = _stats.get(name, 0) + value
+
+
+def stats():
+    with _stats_lock:
+        ret = dict(_stats)
+    channels = {}
+    depths = request_queue.depths()
+    queued_bytes = request_queue.queued_bytes()
+    paused = request_queue.paused()
+    for channel, chinfo in list(NvimHandler.channel_sockets.items()):
+        channels[str(channel)] = dict(
+            queue_depth=depths.get(channel, 0),
+            queue_bytes=queued_bytes.get(channel, 0),
+            read_paused=int(channel in paused),
+            write_queued_bytes=chinfo['writer'].queued_bytes)
+    ret['channels'] = channels
+    return ret
+
 
 def _channel_id_new():
     with _channel_id_new._lock:
@@ -51,26 +231,85 @@ _channel_id_new._counter = 0
 _channel_id_new._lock = threading.Lock()
 
 
+def _request_id_new():
+    with _request_id_new._lock:
+        _request_id_new._counter += 1
+        return _request_id_new._counter
+
+
+# static local
+_request_id_new._counter = 0
+_request_id_new._lock = threading.Lock()
+
+
+# Notified whenever request_queue gets a new item or a response for a
+# blocking rpcrequest() arrives, so that the main thread blocking in
+# rpcrequest() can wake up without a round trip through vim.
+_request_cond = threading.Condition()
+
+
+def _request_cond_notify():
+    with _request_cond:
+        _request_cond.notify_all()
+
+
 class VimHandler(socketserver.BaseRequestHandler):
 
     _lock = threading.Lock()
     _sock = None
+    # True while a process_pending_requests wakeup is sent but the drain has
+    # not started yet, so bursts of messages only wake vim once
+    _wake_pending = False
 
     @classmethod
     def notify(cls, cmd=None):
+        wakeup = cmd is None
         try:
-            if cmd is None:
+            if wakeup:
                 cmd = vim_py + " neovim_rpc_server.process_pending_requests()"
             if not VimHandler._sock:
                 return
             with VimHandler._lock:
+                if wakeup:
+                    if VimHandler._wake_pending:
+                        _stat_add('wakeups_coalesced')
+                        return
+                    VimHandler._wake_pending = True
                 encoded = json.dumps(['ex', cmd])
                 logger.info("sending notification: %s", encoded)
-                VimHandler._sock.send(encoded.encode('utf-8'))
+                try:
+                    VimHandler._sock.sendall(encoded.encode('utf-8'))
+                except Exception:
+                    if wakeup:
+                        VimHandler._wake_pending = False
+                    raise
+                if wakeup:
+                    _stat_add('wakeups_sent')
         except Exception as ex:
             logger.exception(
                 'VimHandler notify exception for [%s]: %s', cmd, ex)
 
+    @classmethod
+    def wakeup_scheduled(cls):
+        """Called by the main thread when it re-arms draining by itself."""
+        with VimHandler._lock:
+            VimHandler._wake_pending = True
+
+    @classmethod
+    def wakeup_received(cls):
+        """Called by the main thread right before draining request_queue."""
+        with VimHandler._lock:
+            VimHandler._wake_pending = False
+
+    @classmethod
+    def send(cls, sock, content):
+        """Write a json message to vim, the lock keeps the writes of
+        different threads from interleaving."""
+        encoded = json.dumps(content)
+        logger.info("sending %s", encoded)
+        with VimHandler._lock:
+            sock.sendall(encoded.encode('utf-8'))
+
     @classmethod
     def notify_exited(cls, channel):
         try:
@@ -82,15 +321,10 @@ class VimHandler(socketserver.BaseRequestHandler):
     # each connection is a thread
     def handle(self):
         logger.info("=== socket opened ===")
-        data = None
+        stream = JsonStream()
         while True:
             try:
                 rcv = self.request.recv(4096)
-                # 16k buffer by default
-                if data:
-                    data += rcv
-                else:
-                    data = rcv
             except socket.error:
                 logger.info("=== socket error ===")
                 break
@@ -100,34 +334,30 @@ class VimHandler(socketserver.BaseRequestHandler):
             if len(rcv) == 0:
                 logger.info("=== socket closed ===")
                 break
-            logger.info("received: %s", data)
-            try:
-                decoded = json.loads(data.decode('utf-8'))
-            except ValueError:
-                logger.exception("json decoding failed, wait for more data")
-                continue
-            data = None
+            logger.info("received: %s", rcv)
+            for decoded in stream.feed(rcv):
+                VimHandler.handle_message(self.request, decoded)
 
-            # Send a response if the sequence number is positive.
-            # Negative numbers are used for "eval" responses.
-            if (len(decoded) >= 2 and decoded[0] >= 0 and
-                    decoded[1] == 'neovim_rpc_setup'):
+    @classmethod
+    def handle_message(cls, sock, decoded):
+        # Send a response if the sequence number is positive.
+        # Negative numbers are used for "eval" responses.
+        if (len(decoded) >= 2 and decoded[0] >= 0 and
+                decoded[1] == 'neovim_rpc_setup'):
 
-                VimHandler._sock = self.request
+            VimHandler._sock = sock
 
-                # initial setup
-                encoded = json.dumps(['ex', "call neovim_rpc#_callback()"])
-                logger.info("sending {0}".format(encoded))
-                self.request.send(encoded.encode('utf-8'))
+            # initial setup
+            cls.send(sock, ['ex', "call neovim_rpc#_callback()"])
 
-            else:
-                # recognize as rpcrequest
-                reqid = decoded[0]
-                channel = decoded[1][1]
-                event = decoded[1][2]
-                args = decoded[1][3]
-                rspid = decoded[1][4]
-                NvimHandler.request(self.request,
+        else:
+            # recognize as rpcrequest
+            reqid = decoded[0]
+            channel = decoded[1][1]
+            event = decoded[1][2]
+            args = decoded[1][3]
+            rspid = decoded[1][4]
+            NvimHandler.vim_request(sock,
                                     channel,
                                     reqid,
                                     event,
@@ -135,18 +365,209 @@ class VimHandler(socketserver.BaseRequestHandler):
                                     rspid)
 
 
-class SocketToStream():
+class JsonStream():
+    """Incremental decoder for vim's json channel.
+
+    Vim terminates every message with a newline, and newlines inside json
+    strings are always escaped, so a message is only decoded once its
+    terminating newline has arrived. Bytes that have already been scanned are
+    never scanned again, which keeps large messages linear.
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+        # start of the first undecoded message in _buf
+        self._start = 0
+        # position up to which _buf is known to have no newline
+        self._scanned = 0
+        self._decoder = json.JSONDecoder()
+
+    def feed(self, data):
+        """Append data and return the list of complete messages."""
+        self._buf += data
+        messages = []
+        while True:
+            end = self._buf.find(b'\n', self._scanned)
+            if end < 0:
+                self._scanned = len(self._buf)
+                break
+            end += 1
+            text = self._buf[self._start:end].decode('utf-8')
+            self._start = self._scanned = end
+            self._decode(text, messages)
+        self._compact()
+        return messages
+
+    def _decode(self, text, messages):
+        # a single line may still carry several messages
+        idx = 0
+        size = len(text)
+        while True:
+            while idx < size and text[idx].isspace():
+                idx += 1
+            if idx >= size:
+                return
+            try:
+                obj, idx = self._decoder.raw_decode(text, idx)
+            except ValueError:
+                logger.exception("json decoding failed, dropping: %s",
+                                 text[idx:])
+                return
+            messages.append(obj)
+
+    def _compact(self):
+        # drop consumed bytes only when they dominate the buffer, so that a
+        # partial tail is not copied on every read
+        if self._start and self._start * 2 >= len(self._buf):
+            del self._buf[:self._start]
+            self._scanned -= self._start
+            self._start = 0
+
 
-    def __init__(self, sock):
+class ChannelWriter():
+    """Outbound queue of a client channel.
+
+    Messages may be written from any thread. They are sent in order by a
+    dedicated thread, which coalesces everything queued since its last
+    flush into a single sendall call.
+    """
+
+    def __init__(self, sock, channel):
         self._sock = sock
+        self._channel = channel
+        self._cond = threading.Condition()
+        self._queue = []
+        self._queued_bytes = 0
+        # enqueue time of the oldest message in _queue
+        self._queued_since = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def queued_bytes(self):
+        return self._queued_bytes
+
+    def write(self, packed):
+        with self._cond:
+            if self._closed:
+                raise IOError('channel %s closed' % self._channel)
+            if not self._queue:
+                self._queued_since = _clock()
+            self._queue.append(packed)
+            self._queued_bytes += len(packed)
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                batch = self._queue
+                size = self._queued_bytes
+                since = self._queued_since
+                self._queue = []
+                self._queued_bytes = 0
+            try:
+                self._sock.sendall(b''.join(batch))
+            except Exception as ex:
+                logger.info("channel[%s] write failed: %s", self._channel, ex)
+                self.close()
+                return
+            _record_flush(len(batch), size, since)
+
+
+def _record_flush(messages, size, since):
+    latency = (_clock() - since) * 1000
+    with _stats_lock:
+        _stats['write_batches'] += 1
+        _stats['write_messages'] += messages
+        _stats['write_bytes'] += size
+        _stats['write_flush_ms_total'] += latency
+        _stats['write_flush_ms_max'] = max(
+            _stats['write_flush_ms_max'], latency)
+
+
+class EventLoopWriter():
+    """Outbound queue of a client channel served by EventLoopServer.
 
-    def read(self, cnt):
-        if cnt > 4096:
-            cnt = 4096
-        return self._sock.recv(cnt)
+    Same interface as ChannelWriter, but the non-blocking socket is written
+    by the event loop thread whenever it is writable.
+    """
 
-    def write(self, w):
-        return self._sock.send(w)
+    def __init__(self, loop, sock, channel):
+        self._loop = loop
+        self._sock = sock
+        self._channel = channel
+        self._lock = threading.Lock()
+        self._queue = []
+        self._queued_bytes = 0
+        self._queued_since = None
+        # the part of the current batch the socket has not accepted yet,
+        # only touched by the loop thread
+        self._out = None
+        self._out_messages = 0
+        self._out_size = 0
+        self._out_since = None
+        self._closed = False
+
+    @property
+    def queued_bytes(self):
+        return self._queued_bytes
+
+    def write(self, packed):
+        with self._lock:
+            if self._closed:
+                raise IOError('channel %s closed' % self._channel)
+            if not self._queue:
+                self._queued_since = _clock()
+            self._queue.append(packed)
+            self._queued_bytes += len(packed)
+        self._loop.request_flush(self)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+
+    def flush(self):
+        """Send as much as the socket accepts, called by the loop thread.
+
+        Returns True if nothing is left to send."""
+        if self._out is None:
+            with self._lock:
+                if not self._queue:
+                    return True
+                batch = self._queue
+                self._out_size = self._queued_bytes
+                self._out_since = self._queued_since
+                self._queue = []
+                self._queued_bytes = 0
+            self._out = memoryview(b''.join(batch))
+            self._out_messages = len(batch)
+        try:
+            sent = self._sock.send(self._out)
+        except socket.error as ex:
+            if ex.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            logger.info("channel[%s] write failed: %s", self._channel, ex)
+            self.close()
+            self._out = None
+            return True
+        self._out = self._out[sent:]
+        if len(self._out):
+            return False
+        self._out = None
+        _record_flush(self._out_messages, self._out_size, self._out_since)
+        # more may have been queued in the meantime
+        return self.flush()
 
 
 class NvimHandler(socketserver.BaseRequestHandler):
@@ -157,55 +578,100 @@ class NvimHandler(socketserver.BaseRequestHandler):
 
         logger.info("=== socket opened for client ===")
 
-        channel = _channel_id_new()
-
         sock = self.request
-        chinfo = dict(sock=sock)
-        NvimHandler.channel_sockets[channel] = chinfo
+        channel, chinfo = NvimHandler.open_channel(sock, ChannelWriter)
 
         try:
-            f = SocketToStream(sock)
-            unpacker = msgpack.Unpacker(f)
-            for unpacked in unpacker:
-                logger.info("unpacked: %s", unpacked)
-
-                # response format:
-                #   - msg[0]: 1
-                #   - msg[1]: the request id
-                #   - msg[2]: error(if any), format: [code,str]
-                #   - msg[3]: result(if not errored)
-                if int(unpacked[0]) == 1:
-                    unpacked = neovim_rpc_protocol.from_client(unpacked)
-                    reqid = int(unpacked[1])
-                    rspid, vimsock = chinfo[reqid]
-                    err = unpacked[2]
-                    result = unpacked[3]
-                    # VIM fails to parse response when there a sleep in neovim
-                    # client. I cannot figure out why. Use global responses to
-                    # workaround this issue.
-                    responses[rspid] = [err, result]
-                    content = [reqid, '']
-                    tosend = json.dumps(content)
-                    # vimsock.send
-                    vimsock.send(tosend.encode('utf-8'))
-                    chinfo.pop(reqid)
-                    continue
-
-                request_queue.put((f, channel, unpacked))
-                # notify vim in order to process request in main thread, and
-                # avoiding the stupid json protocol
-                VimHandler.notify()
+            # read into a preallocated buffer and feed the unpacker with a
+            # view of it, instead of allocating a bytes object per recv
+            buf = bytearray(_read_size)
+            view = memoryview(buf)
+            unpacker = neovim_rpc_protocol.unpacker()
+            # offset of the next message in the unpacker's stream
+            offset = 0
+            resumed = threading.Event()
+            while True:
+                cnt = sock.recv_into(buf)
+                if not cnt:
+                    break
+                unpacker.feed(view[:cnt])
+                for unpacked in unpacker:
+                    size = unpacker.tell() - offset
+                    offset += size
+                    NvimHandler.handle_message(channel, chinfo, unpacked,
+                                               size)
+                resumed.clear()
+                if request_queue.pause_if_full(channel, resumed.set):
+                    # stop reading, so that tcp flow control pushes back on
+                    # the client
+                    resumed.wait()
 
             logger.info('channel %s closed.', channel)
 
         except Exception:
             logger.exception('unpacker failed.')
         finally:
-            try:
-                NvimHandler.channel_sockets.pop(channel)
-                sock.close()
-            except Exception:
-                pass
+            NvimHandler.close_channel(channel, chinfo)
+
+    @classmethod
+    def open_channel(cls, sock, writer_factory):
+        channel = _channel_id_new()
+        writer = writer_factory(sock, channel)
+        # pending maps request ids sent to the client to their response
+        # callbacks
+        chinfo = dict(sock=sock, writer=writer, pending={},
+                      packer=neovim_rpc_protocol.Packer())
+        cls.channel_sockets[channel] = chinfo
+        return channel, chinfo
+
+    @classmethod
+    def close_channel(cls, channel, chinfo):
+        try:
+            cls.channel_sockets.pop(channel)
+            chinfo['writer'].close()
+            chinfo['sock'].close()
+        except Exception:
+            pass
+        # nobody is going to answer the outstanding requests
+        pending = chinfo['pending']
+        for reqid in list(pending.keys()):
+            on_response = pending.pop(reqid, None)
+            if on_response:
+                on_response('channel %s closed' % channel, None)
+
+    @classmethod
+    def handle_message(cls, channel, chinfo, unpacked, size=0):
+        logger.info("unpacked: %s", unpacked)
+
+        # response format:
+        #   - msg[0]: 1
+        #   - msg[1]: the request id
+        #   - msg[2]: error(if any), format: [code,str]
+        #   - msg[3]: result(if not errored)
+        if int(unpacked[0]) == 1:
+            reqid = int(unpacked[1])
+            on_response = chinfo['pending'].pop(reqid, None)
+            if on_response is None:
+                logger.error("channel[%s] unexpected response: %s",
+                             channel, unpacked)
+                return
+            on_response(unpacked[2], unpacked[3])
+            return
+
+        if (int(unpacked[0]) == 0 and
+                unpacked[2] in neovim_rpc_metadata.API_INFO_METHODS):
+            # the first request of every client, answered right here with
+            # the pre-packed metadata, no need to wake up vim
+            chinfo['writer'].write(
+                neovim_rpc_metadata.packed_api_info_response(
+                    unpacked[1], channel))
+            return
+
+        request_queue.put((chinfo['writer'], channel, unpacked), size)
+        _request_cond_notify()
+        # notify vim in order to process request in main thread, and
+        # avoiding the stupid json protocol
+        VimHandler.notify()
 
     @classmethod
     def notify(cls, channel, event, args):
@@ -214,7 +680,6 @@ class NvimHandler(socketserver.BaseRequestHandler):
             if channel not in cls.channel_sockets:
                 logger.info("channel[%s] not in NvimHandler", channel)
                 return
-            sock = cls.channel_sockets[channel]['sock']
 
             # notification format:
             #   - msg[0] type, which is 2
@@ -223,23 +688,28 @@ class NvimHandler(socketserver.BaseRequestHandler):
             content = [2, event, args]
 
             logger.info("notify channel[%s]: %s", channel, content)
-            packed = msgpack.packb(neovim_rpc_protocol.to_client(content))
-            sock.send(packed)
+            chinfo = cls.channel_sockets[channel]
+            chinfo['writer'].write(chinfo['packer'].pack(content))
         except Exception as ex:
             logger.exception("notify failed: %s", ex)
 
     @classmethod
-    def request(cls, vimsock, channel, reqid, event, args, rspid):
+    def request(cls, channel, event, args, on_response):
+        """Send a request, on_response(err, result) is called with the raw
+        unpacked response from the client's socket thread.
+
+        Returns the request id, or None if the request could not be
+        sent."""
         try:
-            reqid = int(reqid)
             channel = int(channel)
-            chinfo = cls.channel_sockets[channel]
+            chinfo = cls.channel_sockets.get(channel, None)
 
-            if channel not in cls.channel_sockets:
+            if chinfo is None:
                 logger.info("channel[%s] not in NvimHandler", channel)
-                return
+                return None
 
-            sock = chinfo['sock']
+            writer = chinfo['writer']
+            reqid = _request_id_new()
             # request format:
             #   - msg[0] type, which is 0
             #   - msg[1] request id
@@ -247,13 +717,41 @@ class NvimHandler(socketserver.BaseRequestHandler):
             #   - msg[3] arguments
             content = [0, reqid, event, args]
 
-            chinfo[reqid] = [rspid, vimsock]
+            chinfo['pending'][reqid] = on_response
 
             logger.info("request channel[%s]: %s", channel, content)
-            packed = msgpack.packb(neovim_rpc_protocol.to_client(content))
-            sock.send(packed)
+            try:
+                writer.write(chinfo['packer'].pack(content))
+            except Exception:
+                chinfo['pending'].pop(reqid, None)
+                raise
+            return reqid
         except Exception as ex:
             logger.exception("request failed: %s", ex)
+            return None
+
+    @classmethod
+    def cancel(cls, channel, reqid):
+        """Forget a request sent by request(), its response is dropped."""
+        chinfo = cls.channel_sockets.get(int(channel), None)
+        if chinfo is not None:
+            chinfo['pending'].pop(reqid, None)
+
+    @classmethod
+    def vim_request(cls, vimsock, channel, vimreqid, event, args, rspid):
+        """rpcrequest forwarded through the vim json channel, the fallback of
+        the blocking rpcrequest()."""
+
+        def on_response(err, result):
+            # converted by pop_response() on the main thread
+            # VIM fails to parse response when there a sleep in neovim
+            # client. I cannot figure out why. Use global responses to
+            # workaround this issue.
+            responses[rspid] = [err, result]
+            VimHandler.send(vimsock, [vimreqid, ''])
+
+        if cls.request(channel, event, args, on_response) is None:
+            on_response('channel %s request failed' % channel, None)
 
     @classmethod
     def shutdown(cls):
@@ -263,12 +761,206 @@ class NvimHandler(socketserver.BaseRequestHandler):
             if chinfo:
                 sock = chinfo['sock']
                 logger.info("closing client %s", channel)
+                chinfo['writer'].close()
                 # if don't shutdown the socket, vim will never exit because the
                 # recv thread is still blocking
                 sock.shutdown(socket.SHUT_RDWR)
                 sock.close()
 
 
+class EventLoopServer():
+    """Serves the vim control socket and every client socket from a single
+    thread, multiplexed with selectors, instead of one thread per
+    connection. Selected with `let g:neovim_rpc_server_mode = 'selector'`.
+
+    The listening sockets are borrowed from the socketserver instances, only
+    their serve_forever is replaced.
+    """
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        # written by other threads to interrupt select()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ,
+                                self._on_wakeup)
+        self._lock = threading.Lock()
+        self._flush_requests = set()
+        self._resume_requests = set()
+        # per client socket state
+        self._clients = {}
+        self._shutdown = False
+        # shared by all connections since they are read by the loop only
+        self._buf = bytearray(_read_size)
+        self._view = memoryview(self._buf)
+
+    def add_vim_server(self, server):
+        self._selector.register(server.socket, selectors.EVENT_READ,
+                                lambda events: self._accept_vim(server))
+
+    def add_nvim_server(self, server):
+        self._selector.register(server.socket, selectors.EVENT_READ,
+                                lambda events: self._accept_nvim(server))
+
+    def request_flush(self, writer):
+        with self._lock:
+            self._flush_requests.add(writer)
+        self._wakeup()
+
+    def shutdown(self):
+        self._shutdown = True
+        self._wakeup()
+
+    def serve_forever(self):
+        while not self._shutdown:
+            for key, events in self._selector.select():
+                try:
+                    key.data(events)
+                except Exception as ex:
+                    logger.exception("event loop handler failed: %s", ex)
+            with self._lock:
+                writers = self._flush_requests
+                self._flush_requests = set()
+                resumed = self._resume_requests
+                self._resume_requests = set()
+            for writer in writers:
+                self._flush(writer)
+            for sock in resumed:
+                client = self._clients.get(sock)
+                if client is not None:
+                    client['paused'] = False
+                    self._update_events(sock)
+        self._selector.close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+
+    def _wakeup(self):
+        try:
+            self._wakeup_w.send(b'x')
+        except socket.error:
+            # the socket buffer is full, a wakeup is pending anyway
+            pass
+
+    def _on_wakeup(self, events):
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def _accept_vim(self, server):
+        sock, addr = server.socket.accept()
+        logger.info("=== socket opened ===")
+        stream = JsonStream()
+
+        def on_events(events):
+            rcv = self._recv(sock)
+            if not rcv:
+                logger.info("=== socket closed ===")
+                self._selector.unregister(sock)
+                sock.close()
+                return
+            logger.info("received: %s", rcv)
+            for decoded in stream.feed(rcv):
+                VimHandler.handle_message(sock, decoded)
+
+        self._selector.register(sock, selectors.EVENT_READ, on_events)
+
+    def _accept_nvim(self, server):
+        sock, addr = server.socket.accept()
+        logger.info("=== socket opened for client ===")
+        sock.setblocking(False)
+
+        def writer_factory(sock, channel):
+            return EventLoopWriter(self, sock, channel)
+
+        channel, chinfo = NvimHandler.open_channel(sock, writer_factory)
+        writer = chinfo['writer']
+        unpacker = neovim_rpc_protocol.unpacker()
+        # offset of the next message in the unpacker's stream
+        offset = [0]
+
+        def on_events(events):
+            if events & selectors.EVENT_WRITE:
+                self._flush(writer)
+            if not events & selectors.EVENT_READ:
+                return
+            try:
+                cnt = sock.recv_into(self._buf)
+            except socket.error as ex:
+                if ex.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                cnt = 0
+            if cnt:
+                unpacker.feed(self._view[:cnt])
+                try:
+                    for unpacked in unpacker:
+                        size = unpacker.tell() - offset[0]
+                        offset[0] += size
+                        NvimHandler.handle_message(channel, chinfo, unpacked,
+                                                   size)
+                except Exception:
+                    logger.exception('unpacker failed.')
+                else:
+                    if request_queue.pause_if_full(
+                            channel, lambda: self._request_resume(sock)):
+                        # stop reading, so that tcp flow control pushes
+                        # back on the client
+                        client['paused'] = True
+                        self._update_events(sock)
+                    return
+            logger.info('channel %s closed.', channel)
+            client['closed'] = True
+            self._update_events(sock)
+            self._clients.pop(sock, None)
+            NvimHandler.close_channel(channel, chinfo)
+
+        client = dict(on_events=on_events, events=0, paused=False,
+                      want_write=False, closed=False)
+        self._clients[sock] = client
+        self._update_events(sock)
+
+    def _request_resume(self, sock):
+        with self._lock:
+            self._resume_requests.add(sock)
+        self._wakeup()
+
+    def _flush(self, writer):
+        sock = writer._sock
+        client = self._clients.get(sock)
+        if client is None:
+            return
+        client['want_write'] = not writer.flush()
+        self._update_events(sock)
+
+    def _update_events(self, sock):
+        client = self._clients.get(sock)
+        if client is None:
+            return
+        events = 0
+        if not client['closed']:
+            if not client['paused']:
+                events |= selectors.EVENT_READ
+            if client['want_write']:
+                events |= selectors.EVENT_WRITE
+        if events == client['events']:
+            return
+        if not client['events']:
+            self._selector.register(sock, events, client['on_events'])
+        elif not events:
+            self._selector.unregister(sock)
+        else:
+            self._selector.modify(sock, events, client['on_events'])
+        client['events'] = events
+
+    def _recv(self, sock):
+        try:
+            return sock.recv(_read_size)
+        except socket.error:
+            return b''
+
+
 # copied from neovim python-client/neovim/__init__.py
 def _setup_logging(name):
     """Setup logging according to environment variables."""
@@ -305,13 +997,66 @@ else:
     has_unix = False
 
 
+# milliseconds spent in each phase of start(), see neovim_rpc#startup_profile
+_startup_profile = {}
+
+
+def startup_profile():
+    return dict(_startup_profile)
+
+
+def _profile(name, since):
+    now = _clock()
+    _startup_profile[name] = (now - since) * 1000
+    return now
+
+
 def start():
+    """Called from vim's main thread, returns the [client server, vim server]
+    addresses. The servers may have been prepared in the background by
+    neovim_rpc_warmup already."""
+
+    since = _clock()
+
+    warmed_up = neovim_rpc_warmup.wait()
+    since = _profile('start_warmup_wait', since)
+    if not warmed_up:
+        prepare(vim.eval('neovim_rpc#_server_options()'))
+
+    global vim_error, vim_on_async_response, vim_py
+    vim_error = vim.Function('neovim_rpc#_error')
+    vim_on_async_response = vim.Function('neovim_rpc#_on_async_response')
+    vim_py = vim.eval('g:neovim_rpc#py')
+    neovim_rpc_protocol.init()
+    _profile('start_init', since)
+
+    return list(_addresses)
+
+
+def prepare(options):
+    """Create the servers and start serving, doesn't touch vim so it may run
+    on any thread. options is the neovim_rpc#_server_options() dict, with
+    string values as returned by vim.eval."""
+
+    since = _clock()
 
     _setup_logging('neovim_rpc_server')
 
+    global _read_size
+    _read_size = max(4096, int(options['read_size']))
+    request_queue.max_messages = int(options['channel_max_messages'])
+    request_queue.max_bytes = int(options['channel_max_bytes'])
+    neovim_rpc_metadata.full = bool(int(options['full_api_info']))
+    mode = options['server_mode']
+    if mode == 'selector' and selectors is None:
+        logger.info("selectors not available, fallback to thread mode")
+        mode = 'thread'
+    since = _profile('start_options', since)
+
     # 0 for random port
     global _vim_server
     global _nvim_server
+    global _addresses
 
     _vim_server = ThreadedTCPServer(("127.0.0.1", 0), VimHandler)
     _vim_server.daemon_threads = True
@@ -341,116 +1086,545 @@ def start():
         nvim_server_addr = "{addr[0]}:{addr[1]}".format(
             addr=_nvim_server.server_address)
     else:
-        nvim_server_addr = vim.eval('tempname()')
+        nvim_server_addr = options['tempname']
         _nvim_server = ThreadedUnixServer(nvim_server_addr, NvimHandler)
     _nvim_server.daemon_threads = True
+    since = _profile('start_create_servers', since)
+
+    global _event_loop
+    if mode == 'selector':
+        # a single thread for all connections
+        _event_loop = EventLoopServer()
+        _event_loop.add_vim_server(_vim_server)
+        _event_loop.add_nvim_server(_nvim_server)
+        loop_thread = threading.Thread(target=_event_loop.serve_forever)
+        loop_thread.daemon = True
+        loop_thread.start()
+    else:
+        # Start a thread with the server -- that thread will then start one
+        # more thread for each request
+        main_server_thread = threading.Thread(
+            target=_vim_server.serve_forever)
+        clients_server_thread = threading.Thread(
+            target=_nvim_server.serve_forever)
 
-    # Start a thread with the server -- that thread will then start one
-    # more thread for each request
-    main_server_thread = threading.Thread(target=_vim_server.serve_forever)
-    clients_server_thread = threading.Thread(target=_nvim_server.serve_forever)
-
-    # Exit the server thread when the main thread terminates
-    main_server_thread.daemon = True
-    main_server_thread.start()
-    clients_server_thread.daemon = True
-    clients_server_thread.start()
+        # Exit the server thread when the main thread terminates
+        main_server_thread.daemon = True
+        main_server_thread.start()
+        clients_server_thread.daemon = True
+        clients_server_thread.start()
+    _profile('start_threads', since)
 
-    return [nvim_server_addr, vim_server_addr]
+    _addresses = [nvim_server_addr, vim_server_addr]
 
 
 def process_pending_requests():
 
     logger.info("process_pending_requests")
+
+    # anything queued from now on needs a new wakeup
+    VimHandler.wakeup_received()
+    _stat_add('drains')
+
+    budget_ms, budget_count = [int(v) for v in vim.eval(
+        "[get(g:, 'neovim_rpc_drain_budget_ms', 0),"
+        " get(g:, 'neovim_rpc_drain_budget_count', 0)]")]
+    deadline = None
+    if budget_ms > 0:
+        deadline = _clock() + budget_ms / 1000.0
+    processed = 0
+
     while True:
 
-        item = None
+        if processed and not request_queue.empty() and (
+                (budget_count > 0 and processed >= budget_count) or
+                (deadline is not None and _clock() >= deadline)):
+            # yield to vim so that user input is not blocked by a chatty
+            # client, the timer resumes draining afterwards
+            logger.info("drain budget exhausted after %s messages",
+                        processed)
+            _stat_add('drains_cut_short')
+            VimHandler.wakeup_scheduled()
+            vim.command('call timer_start(0, "neovim_rpc#_callback")')
+            break
+
         try:
+            item = request_queue.get_nowait()
+        except QueueEmpty:
+            break
+        try:
+            processed += 1
+            _stat_add('messages_processed')
+            _process_item(item)
+        except Exception as ex:
+            logger.exception("exception during process: %s", ex)
 
-            item = request_queue.get(False)
+    _flush_redraw()
 
-            f, channel, msg = item
 
-            msg = neovim_rpc_protocol.from_client(msg)
+def _flush_redraw():
+    try:
+        if neovim_rpc_methods._flush_redraw():
+            _stat_add('redraws')
+    except Exception as ex:
+        logger.exception("redraw failed: %s", ex)
 
-            logger.info("get msg from channel [%s]: %s", channel, msg)
 
-            # request format:
-            #   - msg[0] type, which is 0
-            #   - msg[1] request id
-            #   - msg[2] method
-            #   - msg[3] arguments
+def _process_item(item):
 
-            # notification format:
-            #   - msg[0] type, which is 2
-            #   - msg[1] method
-            #   - msg[2] arguments
+    writer, channel, msg = item
 
-            if msg[0] == 0:
-                # request
+    logger.info("get msg from channel [%s]: %s", channel, msg)
 
-                req_typed, req_id, method, args = msg
+    # request format:
+    #   - msg[0] type, which is 0
+    #   - msg[1] request id
+    #   - msg[2] method
+    #   - msg[3] arguments
 
-                try:
-                    err = None
-                    result = _process_request(channel, method, args)
-                except Exception as ex:
-                    logger.exception("process failed: %s", ex)
-                    # error uccor
-                    err = [1, str(ex)]
-                    result = None
-
-                result = [1, req_id, err, result]
-                logger.info("sending result: %s", result)
-                packed = msgpack.packb(neovim_rpc_protocol.to_client(result))
-                f.write(packed)
-                logger.info("sent")
-            if msg[0] == 2:
-                # notification
-                req_typed, method, args = msg
-                try:
-                    result = _process_request(channel, method, args)
-                    logger.info('notification process result: [%s]', result)
-                except Exception as ex:
-                    logger.exception("process failed: %s", ex)
+    # notification format:
+    #   - msg[0] type, which is 2
+    #   - msg[1] method
+    #   - msg[2] arguments
 
-        except QueueEmpty:
-            pass
+    # response of rpcrequest_async:
+    #   - msg[0] type, which is 1
+    #   - msg[1] callback id
+    #   - msg[2] error
+    #   - msg[3] result
+
+    # from_client resolves buffers and windows, it is called inside the try
+    # so that a failure still answers the request
+
+    if msg[0] == 1:
+        req_typed, cbid, err, result = msg
+        try:
+            err, result = neovim_rpc_protocol.from_client([err, result])
         except Exception as ex:
-            logger.exception("exception during process: %s", ex)
-        finally:
-            if item:
-                request_queue.task_done()
-            else:
-                # item==None means the queue is empty
-                break
+            logger.exception("converting response failed: %s", ex)
+            err, result = [1, str(ex)], None
+        vim_on_async_response(cbid, err, result)
+    if msg[0] == 0:
+        # request
+
+        req_id = msg[1]
+
+        try:
+            err = None
+            req_typed, req_id, method, args = \
+                neovim_rpc_protocol.from_client(msg)
+            result = _process_request(channel, method, args)
+        except Exception as ex:
+            logger.exception("process failed: %s", ex)
+            # error uccor
+            err = [1, str(ex)]
+            result = None
+
+        result = [1, req_id, err, result]
+        logger.info("sending result: %s", result)
+        chinfo = NvimHandler.channel_sockets.get(channel, None)
+        if chinfo is None:
+            logger.info("channel[%s] closed, result dropped", channel)
+            return
+        try:
+            packed = chinfo['packer'].pack(result)
+        except Exception as ex:
+            logger.exception("packing result failed: %s", ex)
+            packed = chinfo['packer'].pack(
+                [1, req_id, [1, 'packing result failed: %s' % ex], None])
+        writer.write(packed)
+        logger.info("sent")
+    if msg[0] == 2:
+        # notification
+        try:
+            req_typed, method, args = neovim_rpc_protocol.from_client(msg)
+            result = _process_request(channel, method, args)
+            logger.info('notification process result: [%s]', result)
+        except Exception as ex:
+            logger.exception("process failed: %s", ex)
+
+
+# deprecated api names that don't follow the prefix renaming rules of
+# _deprecated_target, from neovim's dispatch_deprecated.lua. None marks
+# functions whose semantics differ from their nvim_* successor, e.g.
+# buffer_set_var returns the old value.
+_DEPRECATED_ALIASES = {
+    'vim_get_buffers': 'nvim_list_bufs',
+    'vim_get_windows': 'nvim_list_wins',
+    'vim_get_tabpages': 'nvim_list_tabpages',
+    'vim_get_current_buffer': 'nvim_get_current_buf',
+    'vim_set_current_buffer': 'nvim_set_current_buf',
+    'vim_get_current_window': 'nvim_get_current_win',
+    'vim_set_current_window': 'nvim_set_current_win',
+    'vim_report_error': 'nvim_err_writeln',
+    'vim_name_to_color': 'nvim_get_color_by_name',
+    'vim_change_directory': 'nvim_set_current_dir',
+    'window_get_buffer': 'nvim_win_get_buf',
+    'tabpage_get_windows': 'nvim_tabpage_list_wins',
+    'tabpage_get_window': 'nvim_tabpage_get_win',
+    'buffer_set_var': None,
+    'buffer_del_var': None,
+    'window_set_var': None,
+    'window_del_var': None,
+    'tabpage_set_var': None,
+    'tabpage_del_var': None,
+    'vim_set_var': None,
+    'vim_del_var': None,
+    'buffer_get_line_slice': None,
+    'buffer_set_line_slice': None,
+    'buffer_insert': None,
+    'ui_attach': None,
+}
+
+_DEPRECATED_PREFIXES = [
+    ('buffer_', 'nvim_buf_'),
+    ('window_', 'nvim_win_'),
+    ('tabpage_', 'nvim_tabpage_'),
+    ('ui_', 'nvim_ui_'),
+    ('vim_', 'nvim_'),
+]
+
+
+def _deprecated_target(name):
+    if name in _DEPRECATED_ALIASES:
+        return _DEPRECATED_ALIASES[name]
+    for prefix, replacement in _DEPRECATED_PREFIXES:
+        if name.startswith(prefix):
+            return replacement + name[len(prefix):]
+    return None
+
+
+def _build_dispatch():
+    """Map every rpc method name to its implementation, so a request costs a
+    single dict lookup. Deprecated names listed in API_INFO are resolved to
+    their nvim_* implementation unless neovim_rpc_methods has its own."""
+    dispatch = {}
+    for name in dir(neovim_rpc_methods):
+        func = getattr(neovim_rpc_methods, name)
+        if not name.startswith('_') and callable(func):
+            dispatch[name] = func
+    for name in neovim_rpc_metadata.deprecated_functions():
+        if name in dispatch:
+            continue
+        target = _deprecated_target(name)
+        if target in dispatch:
+            dispatch[name] = dispatch[target]
+    return dispatch
+
+
+# built on first use, see _get_dispatch
+_dispatch = None
+
+
+def _get_dispatch():
+    global _dispatch
+    if _dispatch is None:
+        _dispatch = _build_dispatch()
+    return _dispatch
+
+
+def _implemented_methods():
+    return list(_get_dispatch()) + ['nvim_get_api_info', 'vim_get_api_info',
+                                    'nvim_call_atomic', 'nvim_buf_attach',
+                                    'nvim_buf_detach']
+
+
+neovim_rpc_metadata.set_implemented(_implemented_methods)
+
+# API_INFO['error_types']
+_ERROR_EXCEPTION = 0
+_ERROR_VALIDATION = 1
+# methods already reported to the user as not implemented
+_reported_missing = set()
 
 
 def _process_request(channel, method, args):
-    if hasattr(neovim_rpc_methods, method):
-        return getattr(neovim_rpc_methods, method)(*args)
+    func = _get_dispatch().get(method)
+    if func is not None:
+        return func(*args)
     elif method in ['vim_get_api_info', 'nvim_get_api_info']:
         # the first request sent by neovim python client
-        return [channel, neovim_rpc_server_api_info.API_INFO]
+        return [channel, neovim_rpc_metadata.api_info()]
+    elif method == 'nvim_call_atomic':
+        return _call_atomic(channel, *args)
+    elif method == 'nvim_buf_attach':
+        return _buf_attach(channel, *args)
+    elif method == 'nvim_buf_detach':
+        return _buf_detach(channel, *args)
     else:
         logger.error("method %s not implemented", method)
-        vim_error(
-            "rpc method [%s] not implemented in "
-            "pythonx/neovim_rpc_methods.py. "
-            "Please send PR or contact the mantainer." % method)
+        if method not in _reported_missing:
+            _reported_missing.add(method)
+            vim_error(
+                "rpc method [%s] not implemented in "
+                "pythonx/neovim_rpc_methods.py. "
+                "Please send PR or contact the mantainer." % method)
         raise Exception('%s not implemented' % method)
 
 
+def _call_atomic(channel, calls):
+    """Process a batch of calls in one go, stops at the first failure.
+
+    Returns [results, error], error being [index, error_type, message] of the
+    failed call, or None if all of them succeeded."""
+    results = []
+    for idx, call in enumerate(calls):
+        if not isinstance(call, (list, tuple)) or len(call) != 2:
+            return [results, [idx, _ERROR_VALIDATION,
+                              'Items in calls array must be arrays of size 2']]
+        method, args = call
+        if not isinstance(args, (list, tuple)):
+            return [results, [idx, _ERROR_VALIDATION,
+                              'Args must be Array']]
+        try:
+            results.append(_process_request(channel, method, args))
+        except Exception as ex:
+            logger.exception("atomic call %s failed: %s", method, ex)
+            return [results, [idx, _ERROR_EXCEPTION, str(ex)]]
+    return [results, None]
+
+
+# bufnr -> dict(listener=listener_add() id, channels=set of channels) of the
+# buffers attached with nvim_buf_attach, only used on the main thread
+_attached_buffers = {}
+
+
+def _buf_attach(channel, buf, send_buffer, opts):
+    """nvim_buf_attach, changes are reported by a listener_add() callback,
+    see buf_lines_changed."""
+    if not buf.valid or not int(vim.eval('bufloaded(%d)' % buf.number)):
+        return False
+    if not int(vim.eval("exists('*listener_add')")):
+        raise Exception('nvim_buf_attach requires vim with listener_add()')
+    bufnr = buf.number
+    attached = _attached_buffers.get(bufnr)
+    if attached is None:
+        listener = int(vim.eval(
+            "listener_add('neovim_rpc#_on_buf_lines', %d)" % bufnr))
+        attached = dict(listener=listener, channels=set())
+        _attached_buffers[bufnr] = attached
+    else:
+        # the client must not get changes made before its initial lines
+        vim.command('call listener_flush(%d)' % bufnr)
+    attached['channels'].add(channel)
+    if send_buffer:
+        NvimHandler.notify(channel, 'nvim_buf_lines_event',
+                           [buf, _changedtick(bufnr), 0, -1, buf[:], False])
+    return True
+
+
+def _buf_detach(channel, buf):
+    attached = _attached_buffers.get(buf.number)
+    if attached is None or channel not in attached['channels']:
+        return False
+    # deliver what has been changed before detaching
+    vim.command('call listener_flush(%d)' % buf.number)
+    attached['channels'].discard(channel)
+    NvimHandler.notify(channel, 'nvim_buf_detach_event', [buf])
+    if not attached['channels']:
+        _buf_listener_remove(buf.number)
+    return True
+
+
+def _buf_listener_remove(bufnr):
+    attached = _attached_buffers.pop(bufnr, None)
+    if attached is not None:
+        vim.command('call listener_remove(%d)' % attached['listener'])
+
+
+def _changedtick(bufnr):
+    return int(vim.eval('getbufvar(%d, "changedtick")' % bufnr))
+
+
+def _coalesce_changes(changes):
+    """Merge the changes of a listener callback that touch or overlap each
+    other, returns [lnum, end, added] ranges.
+
+    Like listener_add() reports them, lnum and end of a change refer to the
+    text after the changes before it, end and added being the first line
+    below the change before it was made and the number of lines added.
+    """
+    merged = []
+    for change in changes:
+        lnum, end, added = (int(change['lnum']), int(change['end']),
+                            int(change['added']))
+        if merged and lnum <= merged[-1][1] + merged[-1][2]:
+            if end >= merged[-1][0]:
+                _merge_change(merged[-1], lnum, end, added)
+                continue
+        merged.append([lnum, end, added])
+
+    # the lines of a range are taken from the text after all the changes,
+    # which is wrong if a later range added or deleted lines above its end,
+    # send a single range covering everything then
+    lowest = None
+    for lnum, end, added in reversed(merged):
+        if lowest is not None and lowest < end + added:
+            whole = merged[0]
+            for rng in merged[1:]:
+                _merge_change(whole, *rng)
+            return [whole]
+        if added and (lowest is None or lnum < lowest):
+            lowest = lnum
+    return merged
+
+
+def _merge_change(rng, lnum, end, added):
+    """Extend the [lnum, end, added] range rng by a later change."""
+    rng_lnum, rng_end, rng_added = rng
+    if end >= rng_end + rng_added:
+        # below the range, back to the line numbers before rng
+        end -= rng_added
+    elif end > rng_lnum:
+        end = rng_end
+    rng[0] = min(rng_lnum, lnum)
+    rng[1] = max(rng_end, end)
+    rng[2] = rng_added + added
+
+
+def buf_lines_changed(bufnr, changes):
+    """Called by the listener of an attached buffer with the changes since
+    the last call, sends a nvim_buf_lines_event for each range of adjacent
+    changes to the attached channels."""
+    bufnr = int(bufnr)
+    attached = _attached_buffers.get(bufnr)
+    if attached is None:
+        return
+    # channels closed in the meantime are detached
+    channels = [c for c in attached['channels']
+                if c in NvimHandler.channel_sockets]
+    if not channels:
+        _buf_listener_remove(bufnr)
+        return
+    attached['channels'] = set(channels)
+    buf = vim.buffers[bufnr]
+    tick = _changedtick(bufnr)
+    for lnum, end, added in _coalesce_changes(changes):
+        count = end - lnum + added
+        lines = buf[lnum - 1:lnum - 1 + count] if count > 0 else []
+        event = [buf, tick, lnum - 1, end - 1, lines, False]
+        for channel in channels:
+            NvimHandler.notify(channel, 'nvim_buf_lines_event', event)
+
+
+def buf_unloaded(bufnr):
+    """BufUnload of an attached buffer, detaches every channel like neovim
+    does."""
+    bufnr = int(bufnr)
+    attached = _attached_buffers.get(bufnr)
+    if attached is None:
+        return
+    buf = vim.buffers[bufnr]
+    for channel in attached['channels']:
+        NvimHandler.notify(channel, 'nvim_buf_detach_event', [buf])
+    _buf_listener_remove(bufnr)
+
+
 def rpcnotify(channel, method, args):
-    NvimHandler.notify(channel, method, args)
+    NvimHandler.notify(channel, neovim_rpc_protocol.from_vim(method),
+                       neovim_rpc_protocol.from_vim(args))
+
+
+# seconds between checks for CTRL-C while rpcrequest waits
+_REQUEST_POLL = 0.1
+
+
+def rpcrequest(channel, method, args):
+    """Blocking rpcrequest, called from vim's main thread.
+
+    The request is sent from here and the main thread waits for the response
+    with the GIL released. Requests sent by the client in the meantime, e.g.
+    calling back into vim while handling this request, are processed while
+    waiting. The wait is given up after g:neovim_rpc_request_timeout
+    milliseconds or when the user presses CTRL-C. Returns [err, result].
+    """
+    response = []
+
+    def on_response(err, result):
+        response.append([err, result])
+        _request_cond_notify()
+
+    # a day by default, like the ch_evalexpr of the fallback
+    timeout = int(vim.eval("get(g:, 'neovim_rpc_request_timeout', 86400000)"))
+    method = neovim_rpc_protocol.from_vim(method)
+    reqid = NvimHandler.request(channel, method,
+                                neovim_rpc_protocol.from_vim(args),
+                                on_response)
+    if reqid is None:
+        return ['channel %s request failed' % channel, None]
+
+    deadline = None
+    if timeout > 0:
+        deadline = _clock() + timeout / 1000.0
+    try:
+        while True:
+            with _request_cond:
+                if not response and request_queue.empty():
+                    _request_cond.wait(_REQUEST_POLL)
+            if response:
+                break
+            _process_queued_items()
+            if response:
+                break
+            if deadline is not None and _clock() >= deadline:
+                NvimHandler.cancel(channel, reqid)
+                return ['channel %s request %s timed out' % (channel, method),
+                        None]
+            # vim raises KeyboardInterrupt here if CTRL-C has been typed
+            vim.eval('getchar(1)')
+    except BaseException:
+        NvimHandler.cancel(channel, reqid)
+        raise
+
+    return neovim_rpc_protocol.from_client(response[0])
+
+
+def pop_response(rspid):
+    """The [err, result] of the rpcrequest fallback, stored by the socket
+    thread as it was unpacked."""
+    return neovim_rpc_protocol.from_client(responses.pop(rspid))
+
+
+def rpcrequest_async(channel, method, args, cbid):
+    """Send a request without waiting, the response is queued and handed to
+    neovim_rpc#_on_async_response(cbid, err, result) on the main thread.
+
+    Returns False if the request could not be sent."""
+
+    def on_response(err, result):
+        request_queue.put((None, channel, [1, cbid, err, result]))
+        _request_cond_notify()
+        VimHandler.notify()
+
+    return NvimHandler.request(channel, neovim_rpc_protocol.from_vim(method),
+                               neovim_rpc_protocol.from_vim(args),
+                               on_response) is not None
+
+
+def _process_queued_items():
+    while True:
+        try:
+            item = request_queue.get_nowait()
+        except QueueEmpty:
+            # show the changes while still waiting for the response
+            _flush_redraw()
+            return
+        try:
+            _stat_add('messages_processed')
+            _process_item(item)
+        except Exception as ex:
+            logger.exception("exception during process: %s", ex)
 
 
 def stop():
 
     logger.info("stop begin")
 
-    # close tcp channel server
-    _nvim_server.shutdown()
+    if _event_loop is not None:
+        _event_loop.shutdown()
+    else:
+        # close tcp channel server
+        _nvim_server.shutdown()
     _nvim_server.server_close()
 
     # close the main channel
@@ -464,7 +1638,8 @@ def stop():
 
     try:
         # stop the main channel
-        _vim_server.shutdown()
+        if _event_loop is None:
+            _vim_server.shutdown()
     except Exception as ex:
         logger.info("_vim_server shutodwn failed: %s", ex)
 
@@ -0,0 +1,48 @@
+# vim:set et sw=4 ts=8:
+
+# Opt-in warm-up at VimEnter, `let g:neovim_rpc_warmup = 1`. The server
+# modules are imported and the servers are created on a background thread,
+# so that the first neovim_rpc#serveraddr() call only has to open the vim
+# channel. Importing this module is cheap.
+
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+_thread = None
+_prepared = False
+
+
+def start(options):
+    """Called from vim's main thread with the neovim_rpc#_server_options()
+    dict, as returned by vim.eval."""
+    global _thread
+    if _thread is not None:
+        return
+    _thread = threading.Thread(target=_run, args=(options,))
+    _thread.daemon = True
+    _thread.start()
+
+
+def _run(options):
+    global _prepared
+    try:
+        import neovim_rpc_server
+        neovim_rpc_server.prepare(options)
+        _prepared = True
+    except Exception as ex:
+        logger.exception("warm-up failed: %s", ex)
+
+
+def done():
+    return _thread is not None and not _thread.is_alive()
+
+
+def wait():
+    """Wait for a running warm-up. Returns True if the servers have been
+    prepared by it."""
+    if _thread is not None:
+        _thread.join()
+    return _prepared